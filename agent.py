@@ -0,0 +1,196 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger('uvicorn')
+
+# wall clock for a whole agent run, the last AGENT_FINAL_RESERVE seconds
+# are kept for the final answer
+AGENT_BUDGET = float(os.getenv('AGENT_BUDGET', '30'))
+AGENT_FINAL_RESERVE = float(os.getenv('AGENT_FINAL_RESERVE', '5'))
+AGENT_MAX_ITERATIONS = int(os.getenv('AGENT_MAX_ITERATIONS', '5'))
+AGENT_TOOL_TIMEOUT = float(os.getenv('AGENT_TOOL_TIMEOUT', '10'))
+AGENT_TOOL_CACHE_SIZE = int(os.getenv('AGENT_TOOL_CACHE_SIZE', '1000'))
+
+AgentAction = namedtuple('AgentAction', ['tool', 'tool_input', 'log'])
+
+ACTION = re.compile(
+    r'Action\s*\d*\s*:[\s]*(?:Action\s*:\s*)?(.*?)[ \t]*\n\s*Action\s*\d*\s*Input\s*\d*\s*:[ \t]*(.*)')
+FINAL_ANSWER = 'Final Answer:'
+
+
+class AsyncTool:
+    """A tool the agent can call: an async function of one string.
+
+    Results are cached by input for ttl seconds, 0 doesn't cache.
+    """
+
+    def __init__(self, name, description, run, timeout=AGENT_TOOL_TIMEOUT, ttl=0):
+        self.name = name
+        self.description = description
+        self.run = run
+        self.timeout = timeout
+        self.ttl = ttl
+
+
+class ToolCache:
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+def parse(text):
+    """Returns (actions, final answer) of one step of the model."""
+    actions = []
+    end = 0
+    for m in ACTION.finditer(text):
+        # the log keeps the thought before the action for the scratchpad
+        actions.append(AgentAction(m.group(1).strip(), m.group(2).strip().strip('"'),
+                                   text[end:m.end()]))
+        end = m.end()
+    if actions:
+        return actions, None
+    if FINAL_ANSWER in text:
+        return [], text.split(FINAL_ANSWER, 1)[1].strip()
+    return [], None
+
+
+class AsyncAgent:
+    """A ReAct loop on the event loop, with a time budget.
+
+    Each step asks the model for a thought and one or more actions; the
+    actions of a step don't depend on each other and run concurrently,
+    each with its own timeout. When the budget is nearly used up, or the
+    iterations are, the model is asked for its final answer right away,
+    and if even that fails the last observation is returned.
+    """
+
+    def __init__(self, tools, template, budget=AGENT_BUDGET,
+                 final_reserve=AGENT_FINAL_RESERVE,
+                 max_iterations=AGENT_MAX_ITERATIONS,
+                 cache_size=AGENT_TOOL_CACHE_SIZE):
+        self.tools = {tool.name: tool for tool in tools}
+        self.template = template
+        self.budget = budget
+        self.final_reserve = final_reserve
+        self.max_iterations = max_iterations
+        self.cache = ToolCache(cache_size)
+        self.runs = 0
+        self.forced = 0
+        self.iterations = 0
+        self.tool_calls = 0
+        self.tool_timeouts = 0
+        self.tool_errors = 0
+
+    def render(self, question, steps):
+        scratchpad = ''
+        for action, observation in steps:
+            scratchpad += f'{action.log}\nObservation: {observation}\nThought: '
+        return self.template.format(
+            tools='\n'.join(f'{t.name}: {t.description}' for t in self.tools.values()),
+            tool_names=', '.join(self.tools),
+            input=question,
+            agent_scratchpad=scratchpad,
+        )
+
+    async def call_tool(self, action, deadline):
+        tool = self.tools.get(action.tool)
+        if tool is None:
+            return f'{action.tool} is not a valid tool, try one of [{", ".join(self.tools)}].'
+        key = (tool.name, action.tool_input)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        self.tool_calls += 1
+        timeout = min(tool.timeout, max(0.0, deadline - time.monotonic()))
+        try:
+            result = str(await asyncio.wait_for(tool.run(action.tool_input), timeout))
+        except asyncio.TimeoutError:
+            self.tool_timeouts += 1
+            return f'{tool.name} timed out'
+        except Exception as e:
+            self.tool_errors += 1
+            logger.exception(f'tool {tool.name} failed')
+            return f'{tool.name} failed: {e}'
+        self.cache.put(key, result, tool.ttl)
+        return result
+
+    async def final_answer(self, question, steps, llm, deadline):
+        prompt = self.render(question, steps) + f'I now know the final answer\n{FINAL_ANSWER}'
+        try:
+            timeout = max(0.0, deadline - time.monotonic())
+            answer = (await asyncio.wait_for(llm(prompt), timeout)).strip()
+            if answer:
+                return answer
+        except asyncio.TimeoutError:
+            logger.warning(f'no final answer within the {self.budget}s budget')
+        except Exception:
+            logger.exception('failed to force a final answer')
+        if steps:
+            return steps[-1][1]
+        return "I don't know the answer"
+
+    async def run(self, question, llm):
+        """llm: async function of the prompt, returns the completion
+        stopped before the next observation."""
+        self.runs += 1
+        start = time.monotonic()
+        deadline = start + self.budget
+        steps = []
+        for _ in range(self.max_iterations):
+            remaining = deadline - self.final_reserve - time.monotonic()
+            if remaining <= 0:
+                break
+            self.iterations += 1
+            try:
+                text = await asyncio.wait_for(llm(self.render(question, steps)), remaining)
+            except asyncio.TimeoutError:
+                break
+            actions, answer = parse(text)
+            if answer is not None:
+                return {'output': answer, 'intermediate_steps': steps}
+            if not actions:
+                steps.append((AgentAction('_Exception', text, text), 'Invalid Format: '
+                              'Missing \'Action:\' after \'Thought:\''))
+                continue
+            observations = await asyncio.gather(
+                *[self.call_tool(action, deadline - self.final_reserve) for action in actions])
+            steps.extend(zip(actions, observations))
+        self.forced += 1
+        answer = await self.final_answer(question, steps, llm, deadline)
+        return {'output': answer, 'intermediate_steps': steps}
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'forced': self.forced,
+            'iterations': self.iterations,
+            'tool_calls': self.tool_calls,
+            'tool_timeouts': self.tool_timeouts,
+            'tool_errors': self.tool_errors,
+            'tool_cache_hits': self.cache.hits,
+            'tool_cache_misses': self.cache.misses,
+        }
@@ -0,0 +1,162 @@
+import os
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from memory_index import normalize
+
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', '1') == '1'
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '1000'))
+# cosine similarity of the questions' embeddings for a hit
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.92'))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', '86400'))
+# answers about recent events, or that came from a web search
+ANSWER_CACHE_VOLATILE_TTL = float(os.getenv('ANSWER_CACHE_VOLATILE_TTL', '600'))
+
+# questions about the current moment are never answered from the cache
+BYPASS_PATTERN = re.compile(
+    r'\b(time|today|tonight|tomorrow|yesterday|now|date|weather)\b'
+    r'|現在|今天|今晚|明天|昨天|幾點|几点|日期|天氣|天气', re.I)
+VOLATILE_PATTERN = re.compile(
+    r'\b(news|latest|recent|current|price|score|this (week|month|year))\b'
+    r'|新聞|新闻|最新|最近|價格|价格|比分|今年', re.I)
+# answers that used these tools are not stored
+BYPASS_TOOLS = {'current_time_tool', 'Python_REPL'}
+VOLATILE_TOOLS = {'google_search', 'tavily_search_results_json'}
+
+NUMBER = re.compile(r'\d+(?:\.\d+)?')
+
+
+def normalize_question(text):
+    text = ' '.join(text.lower().split())
+    return text.rstrip('?？!！.。 ')
+
+
+class AnswerCache:
+    """Reuses answers to questions that mean the same thing.
+
+    Questions are looked up by their normalised text first, then by the
+    cosine similarity of their embeddings. Two questions only match if
+    they contain the same numbers, since "what is 3 * 7" and "what is
+    3 * 8" embed almost identically. Entries expire after their TTL and
+    the least recently used one is evicted when the cache is full.
+    """
+
+    def __init__(self, encode, max_size, threshold, ttl, volatile_ttl):
+        self.encode = encode
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        self.volatile_ttl = volatile_ttl
+        self.entries = OrderedDict()
+        self.matrix = None
+        self.keys = []
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.saved = 0.0
+
+    def bypass(self, question):
+        return BYPASS_PATTERN.search(question) is not None
+
+    def entry_ttl(self, question, tools):
+        if any(tool in BYPASS_TOOLS for tool in tools):
+            return 0
+        if VOLATILE_PATTERN.search(question) or any(tool in VOLATILE_TOOLS for tool in tools):
+            return self.volatile_ttl
+        return self.ttl
+
+    def index(self):
+        if self.matrix is None:
+            self.keys = list(self.entries)
+            vectors = [self.entries[key]['vector'] for key in self.keys]
+            self.matrix = np.stack(vectors) if vectors else None
+        return self.matrix
+
+    def remove(self, key):
+        del self.entries[key]
+        self.matrix = None
+
+    def find(self, key, vector, numbers):
+        entry = self.entries.get(key)
+        if entry is not None:
+            return key
+        matrix = self.index()
+        if matrix is None:
+            return None
+        scores = matrix @ vector
+        for i in np.argsort(-scores):
+            if scores[i] < self.threshold:
+                return None
+            candidate = self.keys[i]
+            if self.entries[candidate]['numbers'] == numbers:
+                return candidate
+        return None
+
+    async def get(self, question):
+        """Returns (answer, vector); vector is None if the question bypasses
+        the cache, otherwise pass it back to put() on a miss."""
+        if self.bypass(question):
+            self.bypassed += 1
+            return None, None
+        key = normalize_question(question)
+        vector = normalize((await self.encode([key]))[0])
+        numbers = NUMBER.findall(key)
+        now = time.monotonic()
+        while True:
+            found = self.find(key, vector, numbers)
+            if found is None:
+                break
+            entry = self.entries[found]
+            if entry['expires'] > now:
+                self.entries.move_to_end(found)
+                self.hits += 1
+                self.saved += entry['latency']
+                return entry['answer'], vector
+            self.remove(found)
+        self.misses += 1
+        return None, vector
+
+    def put(self, question, vector, answer, tools=(), latency=0.0):
+        if vector is None or not answer:
+            return
+        ttl = self.entry_ttl(question, tools)
+        if ttl <= 0:
+            return
+        key = normalize_question(question)
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = {
+            'vector': vector,
+            'answer': answer,
+            'numbers': NUMBER.findall(key),
+            'expires': time.monotonic() + ttl,
+            'latency': latency,
+        }
+        self.matrix = None
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'latency_saved': self.saved,
+        }
+
+
+def create_answer_cache():
+    if not ANSWER_CACHE:
+        return None
+    from utils import encode_async
+    return AnswerCache(encode_async, ANSWER_CACHE_SIZE, ANSWER_CACHE_THRESHOLD,
+                       ANSWER_CACHE_TTL, ANSWER_CACHE_VOLATILE_TTL)
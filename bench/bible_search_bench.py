@@ -0,0 +1,107 @@
+"""Relevance and latency of the pastor's bible retrieval.
+
+    python -m bench.bible_search_bench
+    python -m bench.bible_search_bench --no-vector
+
+lexical: BM25 over character bigrams only
+vector:  chroma similarity search over the verse chunks (needs Ollama and
+         a bible_chroma built by `python bible.py`)
+hybrid:  what the pastor uses, lexical first, fused with vector results
+         by RRF unless the lexical match is strong
+
+Run from the repository root with bible-zh.txt present.
+"""
+import time
+import argparse
+import statistics
+
+from bible_search import BibleSearch, bigram_index
+
+# (question, expected verse); the first half quote the verse, the second
+# half only paraphrase it
+QUESTIONS = [
+    ('愛是恆久忍耐，又有恩慈', ('1Co', 13, 4)),
+    ('神愛世人，甚至將他的獨生子賜給他們', ('Jhn', 3, 16)),
+    ('耶和華是我的牧者', ('Psm', 23, 1)),
+    ('起初神創造天地', ('Gen', 1, 1)),
+    ('凡勞苦擔重擔的人可以到我這裡來', ('Mat', 11, 28)),
+    ('我靠著那加給我力量的，凡事都能做', ('Phl', 4, 13)),
+    ('你們要先求他的國和他的義', ('Mat', 6, 33)),
+    ('信就是所望之事的實底', ('Heb', 11, 1)),
+    ('萬事都互相效力，叫愛神的人得益處', ('Rom', 8, 28)),
+    ('敬畏耶和華是知識的開端', ('Pro', 1, 7)),
+    ('我很焦慮，常常擔心明天會怎樣', ('Phl', 4, 6)),
+    ('別人得罪我，我要原諒他幾次', ('Mat', 18, 22)),
+    ('遇到誘惑的時候神會幫助我嗎', ('1Co', 10, 13)),
+    ('神會不會丟下我不管', ('Heb', 13, 5)),
+    ('我覺得自己的罪太重了，神還會赦免我嗎', ('1Jn', 1, 9)),
+    ('怎樣才能得到真正的平安', ('Jhn', 14, 27)),
+]
+
+
+def create_vector_search(model, persist_directory):
+    from bible import use_pysqlite3
+    use_pysqlite3()
+    from langchain_community.embeddings import OllamaEmbeddings
+    from langchain_chroma import Chroma
+    db = Chroma(persist_directory=persist_directory,
+                embedding_function=OllamaEmbeddings(model=model))
+
+    def vector_search(query, k):
+        return db.similarity_search(query, k=k)
+
+    return vector_search
+
+
+def evaluate(search, mode, k):
+    hits = 0
+    reciprocal_ranks = []
+    latencies = []
+    for question, expected in QUESTIONS:
+        start = time.perf_counter()
+        verses = search.search(question, k=k, mode=mode)
+        latencies.append(time.perf_counter() - start)
+        keys = [verse[:3] for verse in verses]
+        rank = keys.index(expected) + 1 if expected in keys else None
+        hits += rank is not None
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+    latencies.sort()
+    return {
+        'hit': hits / len(QUESTIONS),
+        'mrr': statistics.mean(reciprocal_ranks),
+        'p50_ms': statistics.median(latencies) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--model', default='qwen:7b')
+    parser.add_argument('--persist-directory', default='./bible_chroma')
+    parser.add_argument('--no-vector', action='store_true')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if not bigram_index.load():
+        raise SystemExit('bible-zh.txt not found')
+    print(f'index loaded in {(time.perf_counter() - start) * 1000:.0f}ms')
+
+    vector_search = None
+    modes = ['lexical']
+    if not args.no_vector:
+        vector_search = create_vector_search(args.model, args.persist_directory)
+        modes += ['vector', 'hybrid']
+    search = BibleSearch(bigram_index, vector_search)
+
+    print(f'{"mode":<8} {"hit@" + str(args.k):>7} {"mrr":>6} {"p50 ms":>9} {"max ms":>9}')
+    for mode in modes:
+        r = evaluate(search, mode, args.k)
+        print(f'{mode:<8} {r["hit"]:>7.2f} {r["mrr"]:>6.2f} {r["p50_ms"]:>9.2f} {r["max_ms"]:>9.2f}')
+    if vector_search is not None:
+        print(f'hybrid skipped the vector search for '
+              f'{search.lexical_only - len(QUESTIONS)}/{len(QUESTIONS)} questions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Compare throughput and latency of the embedding paths on CPU.
+
+    python -m bench.embedding_bench --requests 512 --concurrency 32
+
+plain:     one SentenceTransformer.encode call per request (the old path)
+batched:   EmbeddingService micro-batching on the torch model
+int8/onnx: EmbeddingService on the quantized backends
+"""
+import os
+import time
+import asyncio
+import argparse
+import statistics
+
+from embedding import EmbeddingService, load_model
+from stats import percentile
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_texts():
+    texts = []
+    for name in ('mittens.txt', 'yoshi.txt'):
+        with open(os.path.join(root, name), 'r') as f:
+            texts += [line.strip() for line in f if line.strip()]
+    return texts
+
+
+async def run_load(encode, texts, n_requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await encode([texts[i % len(texts)]])
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(n_requests)])
+    elapsed = time.perf_counter() - start
+    return {
+        'throughput': n_requests / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def bench_plain(texts, args):
+    model = load_model(MODEL_NAME, 'torch')
+    loop = asyncio.get_running_loop()
+
+    async def encode(batch):
+        return await loop.run_in_executor(None, model.encode, batch)
+
+    return await run_load(encode, texts, args.requests, args.concurrency)
+
+
+async def bench_service(backend, texts, args):
+    service = EmbeddingService(MODEL_NAME, backend=backend,
+                               max_batch_size=args.batch_size,
+                               max_wait=args.max_wait_ms / 1000)
+    try:
+        result = await run_load(service.encode_async, texts, args.requests,
+                                args.concurrency)
+        result.update(service.stats())
+        return result
+    finally:
+        await service.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=512)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    parser.add_argument('--backends', default='torch,int8,onnx')
+    args = parser.parse_args()
+
+    texts = load_texts()
+    results = {'plain': await bench_plain(texts, args)}
+    for backend in args.backends.split(','):
+        try:
+            results[f'batched-{backend}'] = await bench_service(backend, texts, args)
+        except Exception as e:
+            print(f'skipping {backend}: {e}')
+
+    print(f'{"path":<16} {"req/s":>9} {"p50 ms":>9} {"p99 ms":>9}')
+    for name, r in results.items():
+        print(f'{name:<16} {r["throughput"]:>9.1f} {r["p50_ms"]:>9.2f} {r["p99_ms"]:>9.2f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
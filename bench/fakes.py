@@ -0,0 +1,319 @@
+"""Local stand-ins for the services a turn talks to, for the load bench.
+
+MemoryMongoClient / AsyncMemoryMongoClient: the subset of pymongo the bots use
+MemoryChromaClient: an async chroma client with brute force queries
+ollama_app: /api/chat and /api/generate at a set latency and token rate
+line_app: the messaging API (reply, push) and profiles; replies are passed to
+    a callback so the load generator can time them
+"""
+import json
+import time
+import asyncio
+import itertools
+from datetime import datetime, timezone
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+ids = itertools.count(1)
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        value = doc.get(key)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if value is None:
+                    return False
+                if op == '$lt' and not value < operand:
+                    return False
+                if op == '$lte' and not value <= operand:
+                    return False
+                if op == '$gt' and not value > operand:
+                    return False
+                if op == '$gte' and not value >= operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def project(doc, projection):
+    if not projection:
+        return dict(doc)
+    result = {key: doc[key] for key, keep in projection.items() if keep and key in doc}
+    if projection.get('_id', 1) and '_id' in doc:
+        result['_id'] = doc['_id']
+    return result
+
+
+class MemoryCursor:
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        self.docs.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        if n:
+            self.docs = self.docs[:n]
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    async def to_list(self, length=None):
+        return self.docs[:length] if length else list(self.docs)
+
+    def __aiter__(self):
+        return self.aiter()
+
+    async def aiter(self):
+        for doc in self.docs:
+            yield doc
+
+
+class MemoryCollection:
+
+    def __init__(self):
+        self.docs = {}
+
+    def insert_one(self, doc):
+        from pymongo.errors import DuplicateKeyError
+        doc.setdefault('_id', next(ids))
+        if doc['_id'] in self.docs:
+            raise DuplicateKeyError(f"duplicate key {doc['_id']}")
+        self.docs[doc['_id']] = dict(doc)
+
+    def insert_many(self, docs, ordered=True):
+        for doc in docs:
+            doc.setdefault('_id', next(ids))
+            self.docs.setdefault(doc['_id'], dict(doc))
+
+    def find(self, query=None, projection=None):
+        docs = [project(doc, projection) for doc in self.docs.values()
+                if matches(doc, query or {})]
+        return MemoryCursor(docs)
+
+    def find_one(self, query=None, projection=None):
+        return next(iter(self.find(query, projection)), None)
+
+    def update_one(self, query, update, upsert=False):
+        doc = next((doc for doc in self.docs.values() if matches(doc, query)), None)
+        if doc is None:
+            if not upsert:
+                return
+            doc = dict(query, _id=next(ids))
+            self.docs[doc['_id']] = doc
+        doc.update(update.get('$set', {}))
+
+    def delete_one(self, query):
+        for key, doc in list(self.docs.items()):
+            if matches(doc, query):
+                del self.docs[key]
+                return
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def create_indexes(self, *args, **kwargs):
+        pass
+
+
+class AsyncMemoryCollection:
+    """The same collection behind AsyncMongoClient's awaitable methods."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, query=None, projection=None):
+        return self.collection.find(query, projection)
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+class MemoryDatabase:
+
+    def __init__(self, wrap):
+        self.wrap = wrap
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = self.wrap(MemoryCollection())
+        return self.collections[name]
+
+
+class MemoryMongoClient:
+
+    def __init__(self, *args, wrap=lambda collection: collection, **kwargs):
+        self.databases = {}
+        self.wrap = wrap
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(self.wrap)
+        return self.databases[name]
+
+
+class AsyncMemoryMongoClient(MemoryMongoClient):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(wrap=AsyncMemoryCollection)
+
+
+class MemoryChromaCollection:
+
+    def __init__(self):
+        self.records = {}
+
+    async def add(self, ids, embeddings, documents, metadatas):
+        await self.upsert(ids, embeddings, documents, metadatas)
+
+    async def upsert(self, ids, embeddings, documents, metadatas):
+        for i, id in enumerate(ids):
+            self.records[id] = (np.asarray(embeddings[i], dtype=np.float32),
+                                documents[i], metadatas[i])
+
+    async def get(self, ids=None, where=None, include=()):
+        selected = [id for id in (ids or self.records)
+                    if id in self.records and matches(self.records[id][2], where or {})]
+        return {
+            'ids': selected,
+            'embeddings': [self.records[id][0] for id in selected],
+            'documents': [self.records[id][1] for id in selected],
+            'metadatas': [self.records[id][2] for id in selected],
+        }
+
+    async def query(self, query_embeddings, n_results=10, where=None):
+        result = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+        selected = [id for id, record in self.records.items()
+                    if matches(record[2], where or {})]
+        for query in query_embeddings:
+            query = np.asarray(query, dtype=np.float32)
+            distances = [float(np.sum((self.records[id][0] - query) ** 2)) for id in selected]
+            order = np.argsort(distances)[:n_results]
+            result['ids'].append([selected[i] for i in order])
+            result['documents'].append([self.records[selected[i]][1] for i in order])
+            result['metadatas'].append([self.records[selected[i]][2] for i in order])
+            result['distances'].append([distances[i] for i in order])
+        return result
+
+
+class MemoryChromaClient:
+
+    def __init__(self):
+        self.collections = {}
+
+    async def get_or_create_collection(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryChromaCollection()
+        return self.collections[name]
+
+
+WORDS = ('the', 'cat', 'butler', 'bows', 'and', 'brings', 'tea', 'to', 'his',
+         'master', 'while', 'purring', 'softly')
+
+
+def fake_tokens(n):
+    """n tokens of filler text, a sentence every 12 tokens."""
+    for i in range(n):
+        word = WORDS[i % len(WORDS)]
+        yield word + ('. ' if i % 12 == 11 else ' ')
+
+
+def ollama_app(latency=0.2, token_rate=30.0, reply_tokens=60):
+    """A fake Ollama: latency until the first token, then token_rate tokens/s."""
+    app = FastAPI()
+
+    def counts(prompt_chars, started):
+        now = time.monotonic()
+        return {
+            'done': True,
+            'done_reason': 'stop',
+            'total_duration': int((now - started) * 1e9),
+            'prompt_eval_count': prompt_chars // 4,
+            'prompt_eval_duration': int(latency * 1e9),
+            'eval_count': reply_tokens,
+            'eval_duration': int(reply_tokens / token_rate * 1e9),
+        }
+
+    async def generate(body, prompt_chars, field):
+        started = time.monotonic()
+        model = body.get('model')
+        created_at = datetime.now(timezone.utc).isoformat()
+
+        def part(text):
+            if field == 'message':
+                return {'message': {'role': 'assistant', 'content': text}}
+            return {'response': text}
+
+        if not body.get('stream', True):
+            await asyncio.sleep(latency + reply_tokens / token_rate)
+            return {'model': model, 'created_at': created_at,
+                    **part(''.join(fake_tokens(reply_tokens))),
+                    **counts(prompt_chars, started)}
+
+        async def stream():
+            await asyncio.sleep(latency)
+            for token in fake_tokens(reply_tokens):
+                await asyncio.sleep(1 / token_rate)
+                yield json.dumps({'model': model, 'created_at': created_at,
+                                  'done': False, **part(token)}) + '\n'
+            yield json.dumps({'model': model, 'created_at': created_at, **part(''),
+                              **counts(prompt_chars, started)}) + '\n'
+
+        return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+    @app.post('/api/chat')
+    async def chat(request: Request):
+        body = await request.json()
+        chars = sum(len(m.get('content', '')) for m in body.get('messages', []))
+        return await generate(body, chars, 'message')
+
+    @app.post('/api/generate')
+    async def generate_route(request: Request):
+        body = await request.json()
+        if not body.get('prompt'):
+            # warm up, load the model and return
+            return {'model': body.get('model'), 'response': '', 'done': True}
+        return await generate(body, len(body['prompt']), 'response')
+
+    return app
+
+
+def line_app(on_reply, profile_latency=0.02):
+    """A fake LINE API; on_reply(reply_token, messages) for every reply."""
+    app = FastAPI()
+
+    def sent(messages):
+        return {'sentMessages': [{'id': str(next(ids)), 'quoteToken': 'q'}
+                                 for _ in messages]}
+
+    @app.post('/v2/bot/message/reply')
+    async def reply(request: Request):
+        body = await request.json()
+        on_reply(body['replyToken'], body['messages'])
+        return sent(body['messages'])
+
+    @app.post('/v2/bot/message/push')
+    async def push(request: Request):
+        body = await request.json()
+        return sent(body['messages'])
+
+    @app.get('/v2/bot/profile/{user_id}')
+    async def profile(user_id: str):
+        await asyncio.sleep(profile_latency)
+        return {'userId': user_id, 'displayName': f'user {user_id[-4:]}',
+                'language': 'en'}
+
+    return app
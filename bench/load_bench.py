@@ -0,0 +1,304 @@
+"""Load test main:app end to end against local fakes.
+
+    python -m bench.load_bench --bots mittens,yoshi --concurrency 16 --requests 500
+    python -m bench.load_bench --replay requests.jsonl --distribution zipf --json run.json
+    python -m bench.load_bench --baseline run.json --tolerance 0.2
+
+Starts a fake Ollama and a fake LINE API in this process and the app in a
+subprocess (bench.serve, with in-memory Mongo and Chroma), then sends
+signed webhooks from --concurrency virtual users, each waiting for its
+reply before sending the next message. Latency is measured to the reply
+arriving at the fake LINE API, so it includes coalescing, queueing and
+generation, not only the webhook response.
+
+Replay files are JSON lines; the text is taken from `text`, `body` or
+`title`, and optional `bot` and `user_id` fields pick the bot and user.
+Lines with an `offset` (seconds from the start) are sent at that time
+instead of as fast as the virtual users allow.
+
+--baseline compares with a --json result of an earlier run and exits 1
+when reply p95 or throughput got worse by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+import uvicorn
+
+from bench.fakes import ollama_app, line_app
+from bench.serve import bench_secret
+from bench.startup_bench import text_event_body, sign
+from stats import percentile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MESSAGES = [
+    'Good morning!',
+    'What should I have for dinner tonight?',
+    'I had a long day at work, can you cheer me up?',
+    '你今天過得好嗎？',
+    '請問怎麼面對焦慮？',
+    'Tell me a story about a cat.',
+]
+
+
+def load_replay(path):
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text = record.get('text') or record.get('body') or record.get('title')
+            if text:
+                # LINE text messages are at most 5000 characters
+                records.append(dict(record, text=text[:5000]))
+    return records
+
+
+class Replies:
+    """Matches replies at the fake LINE API with the messages sent.
+
+    With coalescing only the last of a user's burst is answered, so a reply
+    also settles the earlier messages of the same bot and user.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.keys = {}
+
+    def expect(self, key, token):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(key, []).append((token, future))
+        self.keys[token] = key
+        return future
+
+    def on_reply(self, token, messages):
+        key = self.keys.pop(token, None)
+        if key is None:
+            return
+        now = time.perf_counter()
+        waiting = self.pending.get(key, [])
+        while waiting:
+            t, future = waiting.pop(0)
+            self.keys.pop(t, None)
+            if not future.done():
+                future.set_result(now)
+            if t == token:
+                break
+
+
+class LoadTest:
+
+    def __init__(self, args, replies):
+        self.args = args
+        self.replies = replies
+        self.bots = args.bots.split(',')
+        weights = [1.0] * args.users
+        if args.distribution == 'zipf':
+            weights = [1.0 / (rank + 1) ** 1.1 for rank in range(args.users)]
+        self.user_weights = weights
+        self.webhook = []
+        self.reply = []
+        self.errors = 0
+        self.timeouts = 0
+
+    def pick_user(self):
+        i = random.choices(range(self.args.users), self.user_weights)[0]
+        return f'Ubench{i:05d}'
+
+    async def send(self, client, bot, user_id, text):
+        token = uuid.uuid4().hex
+        body = text_event_body(text, user_id, token)
+        headers = {'X-Line-Signature': sign(body, bench_secret(bot)),
+                   'Content-Type': 'application/json'}
+        replied = self.replies.expect((bot, user_id), token)
+        start = time.perf_counter()
+        try:
+            r = await client.post(f'{self.args.url}/{bot}', content=body, headers=headers)
+            r.raise_for_status()
+        except httpx.HTTPError:
+            self.errors += 1
+            replied.cancel()
+            return
+        self.webhook.append(time.perf_counter() - start)
+        try:
+            end = await asyncio.wait_for(replied, self.args.reply_timeout)
+            self.reply.append(end - start)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+
+    async def user(self, client, jobs):
+        while jobs:
+            bot, user_id, text = jobs.pop()
+            await self.send(client, bot, user_id, text)
+
+    def job(self, record=None):
+        record = record or {}
+        bot = record.get('bot') or random.choice(self.bots)
+        user_id = record.get('user_id') or self.pick_user()
+        text = record.get('text') or random.choice(MESSAGES)
+        return bot, user_id, text
+
+    async def run(self, records):
+        limits = httpx.Limits(max_connections=self.args.concurrency * 2)
+        async with httpx.AsyncClient(timeout=self.args.reply_timeout, limits=limits) as client:
+            start = time.perf_counter()
+            timed = [r for r in records if 'offset' in r]
+            if timed:
+                tasks = []
+                for record in sorted(timed, key=lambda r: r['offset']):
+                    await asyncio.sleep(max(0.0, start + record['offset'] - time.perf_counter()))
+                    tasks.append(asyncio.create_task(self.send(client, *self.job(record))))
+                await asyncio.gather(*tasks)
+            else:
+                count = self.args.requests or len(records)
+                jobs = [self.job(records[i % len(records)] if records else None)
+                        for i in range(count)][::-1]
+                await asyncio.gather(*[self.user(client, jobs)
+                                       for _ in range(self.args.concurrency)])
+            return time.perf_counter() - start
+
+    def report(self, elapsed, lag):
+        return {
+            'sent': len(self.webhook) + self.errors,
+            'replied': len(self.reply),
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'elapsed': elapsed,
+            'throughput': len(self.reply) / elapsed if elapsed else 0.0,
+            'webhook_p50': percentile(self.webhook, 0.5),
+            'webhook_p95': percentile(self.webhook, 0.95),
+            'webhook_p99': percentile(self.webhook, 0.99),
+            'reply_p50': percentile(self.reply, 0.5),
+            'reply_p95': percentile(self.reply, 0.95),
+            'reply_p99': percentile(self.reply, 0.99),
+            'loop_lag': lag,
+        }
+
+
+async def serve(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port,
+                                           log_level='warning'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+async def wait_ready(url, timeout):
+    start = time.perf_counter()
+    async with httpx.AsyncClient() as client:
+        while time.perf_counter() - start < timeout:
+            try:
+                if (await client.get(f'{url}/ready')).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f'{url} is not ready')
+
+
+async def loop_lag(url):
+    async with httpx.AsyncClient() as client:
+        try:
+            r = await client.get(f'{url}/bench/lag')
+            if r.status_code == 200:
+                return r.json()
+        except httpx.TransportError:
+            pass
+    return None
+
+
+async def run(args):
+    replies = Replies()
+    ollama_url = f'http://127.0.0.1:{args.port + 1}'
+    line_url = f'http://127.0.0.1:{args.port + 2}'
+    fakes = [
+        await serve(ollama_app(args.ollama_latency, args.token_rate, args.reply_tokens),
+                    args.port + 1),
+        await serve(line_app(replies.on_reply, args.profile_latency), args.port + 2),
+    ]
+    app = None
+    if args.url is None:
+        args.url = f'http://127.0.0.1:{args.port}'
+        command = [sys.executable, '-m', 'bench.serve', '--port', str(args.port),
+                   '--ollama', ollama_url, '--line', line_url]
+        if 'pastor' in args.bots.split(','):
+            command.append('--pastor')
+        app = subprocess.Popen(command, cwd=root)
+    try:
+        await wait_ready(args.url, args.timeout)
+        await loop_lag(args.url)
+        test = LoadTest(args, replies)
+        records = load_replay(args.replay) if args.replay else []
+        elapsed = await test.run(records)
+        return test.report(elapsed, await loop_lag(args.url))
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait()
+        for server, task in fakes:
+            server.should_exit = True
+            await task
+
+
+def compare(result, baseline, tolerance):
+    failures = []
+    if result['reply_p95'] > baseline['reply_p95'] * (1 + tolerance):
+        failures.append(f"reply p95 {result['reply_p95']:.3f}s > "
+                        f"baseline {baseline['reply_p95']:.3f}s")
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        failures.append(f"throughput {result['throughput']:.2f}/s < "
+                        f"baseline {baseline['throughput']:.2f}/s")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bots', default='mittens,yoshi')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--distribution', choices=['uniform', 'zipf'], default='uniform')
+    parser.add_argument('--replay', default=None)
+    parser.add_argument('--url', default=None, help='an app already started with bench.serve')
+    parser.add_argument('--port', type=int, default=8014)
+    parser.add_argument('--ollama-latency', type=float, default=0.2)
+    parser.add_argument('--token-rate', type=float, default=30.0)
+    parser.add_argument('--reply-tokens', type=int, default=60)
+    parser.add_argument('--profile-latency', type=float, default=0.02)
+    parser.add_argument('--reply-timeout', type=float, default=60)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--json', default=None)
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    for key, value in result.items():
+        if isinstance(value, float):
+            print(f'{key:<12} {value:10.3f}')
+        else:
+            print(f'{key:<12} {value}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            failures = compare(result, json.load(f), args.tolerance)
+        for failure in failures:
+            print(f'regression: {failure}')
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
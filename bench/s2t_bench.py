@@ -0,0 +1,123 @@
+"""Check that s2t.S2TConverter matches OpenCC('s2t') and compare their speed.
+
+    python -m bench.s2t_bench
+    python -m bench.s2t_bench --cases 50000 --sizes 100,1000,5000
+
+The equivalence check converts a set of replies and random strings built
+from the dictionaries (whole phrases, phrase tails that overlap the next
+phrase, single characters, separators) with both converters, whole and
+in random-sized streamed chunks, and exits non-zero on the first mismatch.
+"""
+import sys
+import time
+import random
+import argparse
+import statistics
+
+import opencc
+
+from s2t import S2TConverter, dictionary_dir, read_dictionary
+
+REPLIES = [
+    '你好！我是耀西，今天想聊些什么呢？',
+    '这个问题很有意思。首先，我们需要了解头发为什么会变白：随着年龄增长，黑色素细胞会逐渐减少。',
+    '发展经济的同时也要注意环境保护，这样才能实现可持续发展。',
+    '我觉得你可以试试早点睡觉，多喝水，适当运动。如果还是不舒服，记得去看医生哦～',
+    '干杯！祝你生日快乐，万事如意，心想事成。',
+    '在这个系统里面，后台程序会定时把数据写回数据库，然后发送通知给用户。',
+    '他说："我们下周一起去公园里面划船吧。" 我回答：好啊，不见不散！',
+    '面对困难的时候，不要轻易放弃 — 坚持下去，总会看见彩虹。',
+]
+SEPARATORS = ['，', '。', ' ', '\n', '-', '？', '！', '：', 'a', 'ok', '1']
+
+
+def random_text(rng, phrases, characters):
+    parts = []
+    for _ in range(rng.randint(1, 16)):
+        r = rng.random()
+        if r < 0.4:
+            phrase = rng.choice(phrases)
+            if rng.random() < 0.3:
+                phrase = phrase[rng.randint(1, len(phrase) - 1):]
+            parts.append(phrase)
+        elif r < 0.8:
+            parts.append(rng.choice(characters))
+        else:
+            parts.append(rng.choice(SEPARATORS))
+    return ''.join(parts)
+
+
+def convert_streamed(converter, text, rng):
+    stream = converter.stream()
+    parts = []
+    i = 0
+    while i < len(text):
+        n = rng.randint(1, 8)
+        parts.append(stream.feed(text[i:i + n]))
+        i += n
+    parts.append(stream.flush())
+    return ''.join(parts)
+
+
+def check(reference, converter, cases, rng):
+    directory = dictionary_dir()
+    phrases = list(read_dictionary(f'{directory}/STPhrases.txt'))
+    characters = list(read_dictionary(f'{directory}/STCharacters.txt'))
+    texts = REPLIES + ['\n'.join(REPLIES)]
+    texts += [random_text(rng, phrases, characters) for _ in range(cases)]
+    for text in texts:
+        expected = reference.convert(text)
+        for name, output in [('convert', converter.convert(text)),
+                             ('stream', convert_streamed(converter, text, rng))]:
+            if output != expected:
+                print(f'{name} mismatch for {text!r}:\n  opencc: {expected!r}\n  s2t:    {output!r}')
+                return False
+    print(f'{len(texts)} texts convert identically, whole and streamed')
+    return True
+
+
+def timed(convert, text, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        convert(text)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', type=int, default=20000)
+    parser.add_argument('--sizes', default='100,1000,5000')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    start = time.perf_counter()
+    reference = opencc.OpenCC('s2t')
+    reference.convert('')
+    print(f'opencc load: {(time.perf_counter() - start) * 1000:.0f}ms')
+    start = time.perf_counter()
+    converter = S2TConverter(cache_path=None)
+    converter.load()
+    print(f's2t compile: {(time.perf_counter() - start) * 1000:.0f}ms')
+    start = time.perf_counter()
+    cached = S2TConverter()
+    cached.load()
+    print(f's2t load:    {(time.perf_counter() - start) * 1000:.0f}ms (cached tables)')
+
+    if not check(reference, converter, args.cases, rng):
+        sys.exit(1)
+
+    corpus = ''.join(REPLIES)
+    print(f'{"chars":>6} {"opencc ms":>10} {"s2t ms":>8} {"speedup":>8}')
+    for size in map(int, args.sizes.split(',')):
+        text = (corpus * (size // len(corpus) + 1))[:size]
+        old = timed(reference.convert, text, args.repeat)
+        new = timed(converter.convert, text, args.repeat)
+        print(f'{size:>6} {old:>10.2f} {new:>8.2f} {old / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Run main:app against in-memory Mongo and Chroma, for the load bench.
+
+    python -m bench.serve --port 8014 --ollama http://127.0.0.1:8015 --line http://127.0.0.1:8016
+
+Every bot in bots.ini gets the channel secret `bench-<name>`. --pastor also
+mounts /pastor (its config.ini must exist; the secret becomes `bench-pastor`).
+GET /bench/lag reports the event loop lag of the app since the last call.
+"""
+import os
+import sys
+import asyncio
+import argparse
+import configparser
+from collections import deque
+from contextlib import asynccontextmanager
+
+from stats import percentile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bench_secret(name):
+    return f'bench-{name}'
+
+
+class LagMonitor:
+    """Sleeps interval seconds in a loop and records how late it wakes up."""
+
+    def __init__(self, interval=0.01, window=100000):
+        self.interval = interval
+        self.lags = deque(maxlen=window)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(loop.time() - start - self.interval)
+
+    def collect(self):
+        lags = list(self.lags)
+        self.lags.clear()
+        return {
+            'samples': len(lags),
+            'p50': percentile(lags, 0.5),
+            'p99': percentile(lags, 0.99),
+            'max': max(lags, default=0.0),
+        }
+
+
+def setup_env(args):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(os.path.join(root, 'bots.ini'))
+    for name in config.sections():
+        os.environ[f'{name.upper()}_LINE_CHANNEL_SECRET'] = bench_secret(name)
+        os.environ.setdefault(f'{name.upper()}_LINE_CHANNEL_ACCESS_TOKEN', 'bench')
+    os.environ['OLLAMA_HOST'] = args.ollama
+    os.environ['LINE_API_HOST'] = args.line
+    os.environ.setdefault('PASTOR_RETRIEVAL', '0')
+    os.environ.setdefault('MEMORY_INDEX', '0')
+
+
+def patch_stores():
+    import pymongo
+    from bench import fakes
+    pymongo.MongoClient = fakes.MemoryMongoClient
+    pymongo.AsyncMongoClient = fakes.AsyncMemoryMongoClient
+
+    import utils
+    chroma = fakes.MemoryChromaClient()
+
+    async def get_async_chroma_client():
+        return chroma
+
+    utils.get_async_mongo_client = fakes.AsyncMemoryMongoClient
+    utils.get_mongo_client = fakes.MemoryMongoClient
+    utils.get_async_chroma_client = get_async_chroma_client
+
+
+def create_app(args):
+    sys.path.insert(0, root)
+    os.chdir(root)
+    setup_env(args)
+    patch_stores()
+    import main
+    app = main.app
+
+    if args.pastor:
+        from linebot.v3.webhook import WebhookParser
+        import pastor
+        pastor.pastor_parser = WebhookParser(bench_secret('pastor'))
+        # mounted before the catch-all POST /{name} of bots.router
+        app.router.routes.insert(0, pastor.router.routes[0])
+
+    monitor = LagMonitor()
+
+    async def lag():
+        return monitor.collect()
+
+    app.add_api_route('/bench/lag', lag, methods=['GET'])
+    lifespan_context = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan(app):
+        task = asyncio.create_task(monitor.run())
+        async with lifespan_context(app) as state:
+            if args.pastor:
+                import pastor
+                await pastor.startup()
+            yield state
+        task.cancel()
+
+    app.router.lifespan_context = lifespan
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8014)
+    parser.add_argument('--ollama', default='http://127.0.0.1:8015')
+    parser.add_argument('--line', default='http://127.0.0.1:8016')
+    parser.add_argument('--pastor', action='store_true')
+    args = parser.parse_args()
+
+    import uvicorn
+    uvicorn.run(create_app(args), host='127.0.0.1', port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Measure how long the app takes to import, start serving and get ready.
+
+    python -m bench.startup_bench --runs 3
+    python -m bench.startup_bench --webhook /mittens --secret $MITTENS_LINE_CHANNEL_SECRET
+
+import:  `import main` in a fresh interpreter
+listen:  uvicorn start until /stats answers
+ready:   uvicorn start until /ready answers 200 (embedder and models warm)
+first:   uvicorn start until the reply to the first signed webhook arrives
+         at a fake LINE API (LINE_API_HOST is pointed at it, Ollama is real)
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import base64
+import hashlib
+import argparse
+import threading
+import subprocess
+import statistics
+
+import httpx
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import main'], cwd=root, check=True)
+    return time.perf_counter() - start
+
+
+def wait_for(client, url, start, timeout, status=200):
+    while time.perf_counter() - start < timeout:
+        try:
+            if client.get(url).status_code == status:
+                return time.perf_counter() - start
+        except httpx.TransportError:
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(url)
+
+
+def text_event_body(text, user_id='Ubench', reply_token='bench-reply-token'):
+    return json.dumps({
+        'destination': 'Ubench',
+        'events': [{
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': int(time.time() * 1000),
+            'webhookEventId': f'bench-{time.time_ns()}',
+            'deliveryContext': {'isRedelivery': False},
+            'replyToken': reply_token,
+            'source': {'type': 'user', 'userId': user_id},
+            'message': {'id': str(time.time_ns()), 'type': 'text', 'quoteToken': 'q', 'text': text},
+        }],
+    })
+
+
+def sign(body, secret):
+    digest = hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+class Replies:
+    """Arrival times of replies at the fake LINE API, by reply token."""
+
+    def __init__(self):
+        self.times = {}
+        self.arrived = threading.Condition()
+
+    def on_reply(self, token, messages):
+        with self.arrived:
+            self.times[token] = time.perf_counter()
+            self.arrived.notify_all()
+
+    def wait(self, token, timeout):
+        with self.arrived:
+            if not self.arrived.wait_for(lambda: token in self.times, timeout):
+                raise TimeoutError(f'no reply for {token}')
+            return self.times[token]
+
+
+def start_line_api(port, replies):
+    import uvicorn
+    from bench.fakes import line_app
+    server = uvicorn.Server(uvicorn.Config(line_app(replies.on_reply), host='127.0.0.1',
+                                           port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def measure_server(args, replies=None):
+    url = f'http://127.0.0.1:{args.port}'
+    env = dict(os.environ)
+    if replies is not None:
+        env['LINE_API_HOST'] = f'http://127.0.0.1:{args.line_port}'
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(args.port)],
+        cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        with httpx.Client(timeout=args.timeout) as client:
+            result = {'listen': wait_for(client, f'{url}/stats', start, args.timeout)}
+            result['ready'] = wait_for(client, f'{url}/ready', start, args.timeout)
+            if args.webhook:
+                token = f'bench-{time.time_ns()}'
+                body = text_event_body('hi', reply_token=token)
+                headers = {'X-Line-Signature': sign(body, args.secret)}
+                client.post(f'{url}{args.webhook}', content=body, headers=headers)
+                result['first'] = replies.wait(token, args.timeout) - start
+            return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--port', type=int, default=8013)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--webhook', default=None)
+    parser.add_argument('--secret', default='')
+    parser.add_argument('--line-port', type=int, default=8012)
+    args = parser.parse_args()
+
+    replies = None
+    if args.webhook:
+        replies = Replies()
+        start_line_api(args.line_port, replies)
+
+    results = {}
+    for _ in range(args.runs):
+        results.setdefault('import', []).append(measure_import())
+        for name, value in measure_server(args, replies).items():
+            results.setdefault(name, []).append(value)
+
+    for name, values in results.items():
+        print(f'{name:<8} median {statistics.median(values):7.2f}s  max {max(values):7.2f}s')
+
+
+if __name__ == '__main__':
+    main()
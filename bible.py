@@ -1,10 +1,20 @@
-__import__('pysqlite3')
+import os
 import sys
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# langchain's Chroma wrapper (used by pastor) reads this collection
+COLLECTION_NAME = 'langchain'
+
+
+def use_pysqlite3():
+  # chromadb needs a newer sqlite3 than the system one, call this before
+  # chromadb is imported
+  import pysqlite3
+  sys.modules['sqlite3'] = pysqlite3
 
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain_chroma import Chroma
-from langchain_core.documents import Document
 
 # a dictionary of bible codes
 bible_codes = {
@@ -107,16 +117,154 @@ def get_bible_chapters():
   return chapters
 
 
+def iter_verses(path='bible-zh.txt'):
+  with open(path, 'r') as f:
+    for line in f:
+      items = line.strip().split(' ', 2)
+      if len(items) < 3 or items[0] not in bible_codes:
+        continue
+      chapter, verse = items[1].split(':')
+      yield items[0], int(chapter), int(verse), items[2]
+
+
+def chunk_verses(verses, size):
+  """Group consecutive verses of the same chapter into chunks of at most
+  `size` verses. The chunk id is derived from the verse range, so it stays
+  the same across runs."""
+
+  def make_chunk(group):
+    code, chapter, start, _ = group[0]
+    end = group[-1][2]
+    book = bible_codes[code]
+    lines = [f'{v} {text}' for _, _, v, text in group]
+    text = f'{book} {chapter}:{start}-{end}\n' + '\n'.join(lines)
+    return {
+      'id': f'{code}.{chapter}.{start}-{end}',
+      'text': text,
+      'metadata': {
+        'book': book,
+        'code': code,
+        'chapter': chapter,
+        'verse': start,
+        'verse_end': end,
+      },
+    }
+
+  group = []
+  for verse in verses:
+    if group and (verse[:2] != group[0][:2] or len(group) == size):
+      yield make_chunk(group)
+      group = []
+    group.append(verse)
+  if group:
+    yield make_chunk(group)
+
+
+def content_hash(model, text):
+  return hashlib.sha1(f'{model}\n{text}'.encode()).hexdigest()
+
+
+def batched(items, size):
+  batch = []
+  for item in items:
+    batch.append(item)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+def batched_head(batches, n):
+  for _ in range(n):
+    batch = next(batches, None)
+    if batch is None:
+      return
+    yield batch
+
+
+def ingest(path, model, persist_directory, verses_per_chunk, batch_size, workers):
+  """Embed the bible into chroma, verse range by verse range.
+
+  Every chunk is stored with the hash of its text and the embedding model,
+  chunks whose hash is already stored are skipped, and each batch is
+  written as soon as it is embedded, so an interrupted run picks up where
+  it stopped. Chunks left over from an older layout are removed at the end.
+  """
+  use_pysqlite3()
+  import chromadb
+  from langchain_community.embeddings import OllamaEmbeddings
+
+  embeddings = OllamaEmbeddings(model=model)
+  client = chromadb.PersistentClient(path=persist_directory)
+  collection = client.get_or_create_collection(COLLECTION_NAME)
+  stored = collection.get(include=['metadatas'])
+  stored_hashes = {
+    id: (metadata or {}).get('hash')
+    for id, metadata in zip(stored['ids'], stored['metadatas'])
+  }
+
+  chunks = []
+  skipped = 0
+  seen = set()
+  for chunk in chunk_verses(iter_verses(path), verses_per_chunk):
+    chunk['metadata']['hash'] = content_hash(model, chunk['text'])
+    seen.add(chunk['id'])
+    if stored_hashes.get(chunk['id']) == chunk['metadata']['hash']:
+      skipped += 1
+    else:
+      chunks.append(chunk)
+  total = len(chunks)
+  print(f'{skipped} chunks up to date, {total} to embed')
+
+  def embed(batch):
+    return batch, embeddings.embed_documents([c['text'] for c in batch])
+
+  start = time.monotonic()
+  done = 0
+  verses = 0
+  with ThreadPoolExecutor(workers) as executor:
+    batches = batched(chunks, batch_size)
+    # keep a bounded number of batches in flight
+    pending = {executor.submit(embed, b) for b in batched_head(batches, workers * 2)}
+    while pending:
+      finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for future in finished:
+        batch, vectors = future.result()
+        collection.upsert(
+          ids=[c['id'] for c in batch],
+          embeddings=vectors,
+          documents=[c['text'] for c in batch],
+          metadatas=[c['metadata'] for c in batch],
+        )
+        done += len(batch)
+        verses += sum(c['metadata']['verse_end'] - c['metadata']['verse'] + 1 for c in batch)
+        elapsed = time.monotonic() - start
+        rate = done / elapsed
+        eta = (total - done) / rate if rate else 0
+        print(f'{done}/{total} chunks, {rate:.2f} chunks/s, '
+              f'{verses / elapsed:.1f} verses/s, eta {eta:.0f}s')
+        for b in batched_head(batches, 1):
+          pending.add(executor.submit(embed, b))
+
+  stale = [id for id in stored_hashes if id not in seen]
+  if stale:
+    collection.delete(ids=stale)
+  print(f'embedded {done} chunks in {time.monotonic() - start:.1f}s, '
+        f'skipped {skipped}, removed {len(stale)} stale')
+
+
 def main():
-  embeddings = OllamaEmbeddings(model='qwen:7b')
-  chapters = get_bible_chapters()
-  documents = [Document(page_content=c) for c in chapters]
-  db = Chroma.from_documents(
-    documents,
-    embedding=embeddings,
-    persist_directory='./bible_chroma'
-  )
-  print(db)
+  parser = argparse.ArgumentParser(description='embed bible-zh.txt into chroma')
+  parser.add_argument('--path', default='bible-zh.txt')
+  parser.add_argument('--model', default=os.getenv('BIBLE_EMBEDDING_MODEL', 'qwen:7b'))
+  parser.add_argument('--persist-directory', default='./bible_chroma')
+  parser.add_argument('--verses', type=int, default=8, help='verses per chunk')
+  parser.add_argument('--batch-size', type=int, default=16)
+  parser.add_argument('--workers', type=int, default=4)
+  args = parser.parse_args()
+  ingest(args.path, args.model, args.persist_directory, args.verses,
+         args.batch_size, args.workers)
 
 
 if __name__ == '__main__':
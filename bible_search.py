@@ -0,0 +1,211 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import Counter, deque
+
+import numpy as np
+
+from scripture import verse_index, book_title
+from stats import percentile
+
+logger = logging.getLogger('uvicorn')
+
+BIBLE_SEARCH_INDEX_PATH = os.getenv('BIBLE_SEARCH_INDEX_PATH', 'data/bible/bigrams.npz')
+BIBLE_SEARCH_K = int(os.getenv('BIBLE_SEARCH_K', '5'))
+# share of the query's idf weight the best verse must contain to skip the
+# vector search
+BIBLE_SEARCH_STRONG = float(os.getenv('BIBLE_SEARCH_STRONG', '0.6'))
+RRF_K = 60
+
+cjk_runs = re.compile(r'[㐀-鿿豈-﫿]+|[a-zA-Z0-9]+')
+
+
+def tokenize(text):
+    """Character bigrams of every CJK run (the character itself for runs of
+    one) and lowercased latin words."""
+    tokens = []
+    for run in cjk_runs.findall(text):
+        if run.isascii():
+            tokens.append(run.lower())
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens += [run[i:i + 2] for i in range(len(run) - 1)]
+    return tokens
+
+
+class BigramIndex:
+    """BM25 over character bigrams of the verses.
+
+    Postings are kept in CSR form: the postings of the i-th token are
+    docs/tfs[offsets[i]:offsets[i + 1]]. Built from the verse index on
+    first use and cached next to it, stamped like the verse index.
+    """
+
+    def __init__(self, verses, path, k1=1.2, b=0.75):
+        self.verses = verses
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.vocabulary = None
+
+    def build(self):
+        postings = {}
+        lengths = np.zeros(len(self.verses), dtype='u2')
+        for i in range(len(self.verses)):
+            tokens = tokenize(self.verses.verse_at(i)[3])
+            lengths[i] = len(tokens)
+            for token, tf in Counter(tokens).items():
+                postings.setdefault(token, []).append((i, tf))
+        vocabulary = sorted(postings)
+        offsets = np.zeros(len(vocabulary) + 1, dtype='i8')
+        offsets[1:] = np.cumsum([len(postings[token]) for token in vocabulary])
+        pairs = np.array([pair for token in vocabulary for pair in postings[token]],
+                         dtype='i4').reshape(-1, 2)
+        return {
+            'vocabulary': np.array(vocabulary),
+            'offsets': offsets,
+            'docs': pairs[:, 0].copy(),
+            'tfs': pairs[:, 1].astype('u2'),
+            'lengths': lengths,
+        }
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return self.vocabulary is not None
+            self.loaded = True
+            if not len(self.verses):
+                return False
+            stamp = self.verses.stamp()
+            data = None
+            if os.path.exists(self.path):
+                with np.load(self.path) as f:
+                    if np.array_equal(f['stamp'], stamp):
+                        data = {key: f[key] for key in f.files}
+            if data is None:
+                start = time.monotonic()
+                data = self.build()
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with open(self.path, 'wb') as f:
+                    np.savez(f, stamp=stamp, **data)
+                logger.info(f'indexed {len(data["vocabulary"])} bigrams in '
+                            f'{time.monotonic() - start:.1f}s')
+
+            self.offsets = data['offsets']
+            self.docs = data['docs']
+            self.tfs = data['tfs'].astype('f4')
+            lengths = data['lengths'].astype('f4')
+            self.norms = self.k1 * (1 - self.b + self.b * lengths / lengths.mean())
+            df = np.diff(self.offsets).astype('f4')
+            n = len(lengths)
+            self.idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+            self.vocabulary = {token: i for i, token in enumerate(data['vocabulary'].tolist())}
+            return True
+
+    def search(self, query, k):
+        """Returns ([(row, score)], coverage) where coverage is the share of
+        the query's idf weight found in the best row."""
+        if not self.load():
+            return [], 0.0
+        terms = [self.vocabulary[t] for t in set(tokenize(query)) if t in self.vocabulary]
+        if not terms:
+            return [], 0.0
+        scores = np.zeros(len(self.norms), dtype='f4')
+        for term in terms:
+            start, end = self.offsets[term], self.offsets[term + 1]
+            docs = self.docs[start:end]
+            tfs = self.tfs[start:end]
+            scores[docs] += self.idf[term] * tfs * (self.k1 + 1) / (tfs + self.norms[docs])
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        results = [(int(i), float(scores[i])) for i in top if scores[i] > 0]
+        if not results:
+            return [], 0.0
+
+        best = results[0][0]
+        weight = sum(self.idf[t] for t in terms)
+        found = 0.0
+        for term in terms:
+            start, end = self.offsets[term], self.offsets[term + 1]
+            if best in self.docs[start:end]:
+                found += self.idf[term]
+        return results, float(found / weight)
+
+
+class BibleSearch:
+    """Hybrid verse retrieval for the pastor bot.
+
+    The bigram index answers first. When its best verse already contains
+    most of the query (quotes, distinctive phrases) the vector search and
+    its embedding call are skipped; otherwise both rankings are fused with
+    reciprocal rank fusion. Vector results are verse-range chunks, every
+    verse of a chunk gets the chunk's rank.
+    """
+
+    def __init__(self, index, vector_search=None, strong=BIBLE_SEARCH_STRONG,
+                 window=1000):
+        self.index = index
+        self.vector_search = vector_search
+        self.strong = strong
+        self.lexical_only = 0
+        self.hybrid = 0
+        self.latencies = deque(maxlen=window)
+
+    def vector_rows(self, query, k):
+        rows = []
+        for doc in self.vector_search(query, k):
+            metadata = doc.metadata
+            if 'code' not in metadata:
+                continue
+            first = self.index.verses.position(metadata['code'], metadata['chapter'],
+                                               metadata['verse'])
+            if first is not None:
+                n = metadata.get('verse_end', metadata['verse']) - metadata['verse'] + 1
+                rows.append(list(range(first, first + n)))
+        return rows
+
+    def search(self, query, k=BIBLE_SEARCH_K, mode='hybrid'):
+        """Returns the top k verses as (code, chapter, verse, text)."""
+        start = time.monotonic()
+        lexical, coverage = [], 0.0
+        if mode != 'vector':
+            lexical, coverage = self.index.search(query, k * 4)
+        if mode == 'lexical' or self.vector_search is None or (
+                lexical and coverage >= self.strong):
+            rows = [row for row, _ in lexical[:k]]
+            self.lexical_only += 1
+        else:
+            scores = Counter()
+            for rank, (row, _) in enumerate(lexical):
+                scores[row] += 1 / (RRF_K + rank + 1)
+            try:
+                for rank, chunk in enumerate(self.vector_rows(query, k * 2)):
+                    for row in chunk:
+                        scores[row] += 1 / (RRF_K + rank + 1)
+            except Exception:
+                logger.exception('bible vector search failed')
+            rows = [row for row, _ in scores.most_common(k)]
+            self.hybrid += 1
+        self.latencies.append(time.monotonic() - start)
+        return [self.index.verses.verse_at(row) for row in rows]
+
+    def stats(self):
+        return {
+            'lexical_only': self.lexical_only,
+            'hybrid': self.hybrid,
+            'p50': percentile(self.latencies, 0.5),
+        }
+
+
+def format_verses(verses):
+    return '\n'.join(f'{book_title(code)} {chapter}:{verse} {text}'
+                     for code, chapter, verse, text in verses)
+
+
+bigram_index = BigramIndex(verse_index, BIBLE_SEARCH_INDEX_PATH)
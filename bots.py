@@ -0,0 +1,171 @@
+import os
+import configparser
+
+from fastapi import APIRouter
+from fastapi import Request, HTTPException
+
+from linebot.v3.webhook import WebhookParser
+from linebot.v3.messaging import ReplyMessageRequest, TextMessage
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+from webhook_queue import dispatch
+from memory_index import create_memory_index
+from write_behind import writer
+from streaming import STREAM_REPLIES, stream_reply
+from prompt import PromptBuilder
+from context import create_context, create_rolling_summary
+from schema import ensure_indexes
+from coalesce import COALESCE_WINDOW, COALESCE_MAX_WAIT, coalescer, merge_text
+from scheduler import Busy
+from tracing import span, trace
+from utils import ChannelApi, get_async_mongo_client, get_user_profile_async, create_async_chroma_getter, create_async_chat_function
+
+BOTS_CONFIG = os.getenv('BOTS_CONFIG', 'bots.ini')
+
+current_dir = os.path.dirname(__file__)
+converters = {}
+
+
+def get_converter(name):
+    if not name:
+        return None
+    if name not in converters:
+        if name != 's2t':
+            raise ValueError(f'unknown converter {name}')
+        from s2t import converter
+        converters[name] = converter
+    return converters[name]
+
+
+class Bot:
+    """A persona: its prompt, model, LINE channel and chat function.
+
+    Everything that holds connections (mongo, chroma, the LINE messaging
+    client) is passed in and shared by all bots.
+    """
+
+    def __init__(self, name, section, mongo_client):
+        env = name.upper()
+        self.name = name
+        self.model = os.getenv(f'{env}_MODEL', section.get('model'))
+        self.channel_access_token = os.getenv(f'{env}_LINE_CHANNEL_ACCESS_TOKEN')
+        self.parser = WebhookParser(os.getenv(f'{env}_LINE_CHANNEL_SECRET'))
+        self.line_api = ChannelApi(self.channel_access_token)
+        self.fallback_name = section.get('fallback_name', 'friend')
+        self.busy_reply = section.get('busy_reply', 'Sorry, I am busy right now. Please try again later.')
+        self.error_reply = section.get('error_reply', 'Sorry, something went wrong. Please ask me again.')
+        self.converter = get_converter(section.get('convert'))
+        self.coalesce_window = section.getfloat('coalesce_window', COALESCE_WINDOW)
+        self.coalesce_max_wait = section.getfloat('coalesce_max_wait', COALESCE_MAX_WAIT)
+
+        with open(os.path.join(current_dir, section['prompt_file']), 'r') as f:
+            persona = f.read()
+        self.prompt = PromptBuilder(
+            persona,
+            section['user_template'],
+            section.get('history_prompt'),
+            section.get('time_template'),
+            summary_prompt=section.get('summary_prompt',
+                                       'Summary of your earlier conversations:'),
+        )
+
+        self.db = mongo_client[name]
+        self.mongo = self.db[name]
+        self.memory = create_memory_index(name)
+        self.summary = create_rolling_summary(self.db, self.mongo, self.model)
+        self.chat = create_async_chat_function(
+            self.prompt,
+            create_async_chroma_getter(name),
+            self.mongo,
+            self.model,
+            name,
+            memory=self.memory,
+            writer=writer,
+            context=create_context(name),
+            summary=self.summary)
+
+    async def startup(self):
+        await ensure_indexes(self.db, self.mongo)
+
+    def convert(self, text):
+        return self.converter.convert(text) if self.converter else text
+
+    async def handle_event(self, event):
+        if not isinstance(event, MessageEvent):
+            return
+        if not isinstance(event.message, TextMessageContent):
+            return
+        if self.coalesce_window > 0:
+            coalescer.add((self.name, event.source.user_id), event, self.handle_events,
+                          self.coalesce_window, self.coalesce_max_wait)
+            return
+        await self.handle_events([event])
+
+    async def handle_events(self, events):
+        with trace(self.name):
+            await self.answer(events)
+
+    async def answer(self, events):
+        event = events[-1]
+        user_id = event.source.user_id
+        user_input = merge_text(events)
+        with span('profile'):
+            profile = await get_user_profile_async(
+                user_id, self.channel_access_token, fallback_name=self.fallback_name)
+        user_name = profile['displayName']
+        try:
+            if STREAM_REPLIES:
+                chunks = self.chat.stream(user_input, user_name, user_id)
+                error_reply = self.error_reply
+                if self.converter:
+                    chunks = self.converter.convert_stream(chunks)
+                    error_reply = self.converter.convert(error_reply)
+                with span('stream_reply'):
+                    await stream_reply(chunks, self.line_api, event.reply_token, user_id,
+                                       error_reply=error_reply)
+                return
+            message = await self.chat(user_input, user_name, user_id)
+        except Busy:
+            # nothing was generated or saved, the reply token is still unused
+            message = self.busy_reply
+        with span('convert'):
+            text = self.convert(message)
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=text)],
+        )
+        with span('reply'):
+            await self.line_api.reply_message(request)
+
+
+def load_bots(path=BOTS_CONFIG):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(os.path.join(current_dir, path))
+    mongo_client = get_async_mongo_client()
+    return {name: Bot(name, config[name], mongo_client) for name in config.sections()}
+
+
+registry = load_bots()
+
+router = APIRouter()
+
+
+@router.post('/{name}')
+async def webhook(name: str, request: Request):
+    bot = registry.get(name)
+    if bot is None:
+        raise HTTPException(status_code=404)
+    signature = request.headers['X-Line-Signature']
+
+    # get request body as text
+    body = await request.body()
+    body = body.decode()
+
+    try:
+        events = bot.parser.parse(body, signature)
+    except InvalidSignatureError:
+        raise HTTPException(status_code=400, detail="Invalid signature")
+
+    await dispatch(events, bot.handle_event)
+    return 'OK'
@@ -0,0 +1,63 @@
+import ast
+import math
+import operator
+
+# bounds that keep a single expression fast: 10 ** 100 is fine, 9 ** 9 ** 9 is not
+MAX_EXPONENT = 100
+MAX_DIGITS = 1000
+MAX_LENGTH = 200
+
+BINARY = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+UNARY = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+def check(value):
+    if isinstance(value, complex):
+        raise ValueError('not a real number')
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError('number too large')
+    if isinstance(value, int) and value.bit_length() > MAX_DIGITS * 10 // 3:
+        raise ValueError('number too large')
+    return value
+
+
+def evaluate_node(node):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return check(node.value)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY:
+        return UNARY[type(node.op)](evaluate_node(node.operand))
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY:
+        left = evaluate_node(node.left)
+        right = evaluate_node(node.right)
+        if isinstance(node.op, ast.Pow) and abs(right) > MAX_EXPONENT:
+            raise ValueError('exponent too large')
+        if isinstance(node.op, ast.Mult) and isinstance(left, int) and isinstance(right, int):
+            if left.bit_length() + right.bit_length() > MAX_DIGITS * 10 // 3:
+                raise ValueError('number too large')
+        return check(BINARY[type(node.op)](left, right))
+    raise ValueError(f'unsupported expression: {ast.dump(node)}')
+
+
+def evaluate(expression):
+    """The value of an arithmetic expression: numbers, + - * / // % ** and
+    parentheses. Anything else raises ValueError, so it is safe for text
+    from the model."""
+    expression = expression.strip().strip('`').strip()
+    if len(expression) > MAX_LENGTH:
+        raise ValueError('expression too long')
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f'not an expression: {expression}') from e
+    return evaluate_node(tree.body)
@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+import logging
+
+from idempotency import deduplicator
+
+logger = logging.getLogger('uvicorn')
+
+# seconds to wait for another message before answering, 0 turns it off;
+# bots.ini overrides these per bot with coalesce_window/coalesce_max_wait
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '0'))
+COALESCE_MAX_WAIT = float(os.getenv('COALESCE_MAX_WAIT', '5.0'))
+
+
+def merge_text(events):
+    return '\n'.join(event.message.text for event in events)
+
+
+class Coalescer:
+    """Debounces text messages per key (bot and user) into one turn.
+
+    Every message restarts the key's window, up to max_wait after the
+    first one; when it closes, all messages go to the handler together and
+    the last one's reply token is used. Messages from one webhook batch
+    and from separate webhook calls are treated alike. Turns of the same
+    key run one after another, so a message that arrives while the
+    previous turn is generating becomes the next turn.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.running = {}
+        self.messages = 0
+        self.turns = 0
+        self.merged = 0
+
+    def add(self, key, event, handle_events, window, max_wait):
+        now = time.monotonic()
+        item = self.pending.get(key)
+        if item is None:
+            item = {'events': [], 'first': now, 'timer': None,
+                    'handle_events': handle_events}
+            self.pending[key] = item
+        else:
+            item['timer'].cancel()
+        item['events'].append(event)
+        self.messages += 1
+        delay = max(0.0, min(window, item['first'] + max_wait - now))
+        item['timer'] = asyncio.get_running_loop().call_later(delay, self.flush, key)
+
+    def flush(self, key):
+        item = self.pending.pop(key)
+        item['timer'].cancel()
+        self.turns += 1
+        self.merged += len(item['events']) - 1
+        previous = self.running.get(key)
+        task = asyncio.ensure_future(
+            self.run(previous, key, item['events'], item['handle_events']))
+        self.running[key] = task
+
+        def done(task):
+            if self.running.get(key) is task:
+                del self.running[key]
+
+        task.add_done_callback(done)
+
+    async def run(self, previous, key, events, handle_events):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await handle_events(events)
+        except Exception:
+            logger.exception(f'failed to handle {len(events)} messages of {key}')
+            # the handler failed after the webhook was acked, forget the ids
+            # so a redelivery of these events isn't dropped
+            for event in events:
+                await deduplicator.release(event)
+
+    async def close(self):
+        # answer what is waiting now, the reply tokens are still valid
+        for key in list(self.pending):
+            self.flush(key)
+        await asyncio.gather(*self.running.values(), return_exceptions=True)
+
+    def stats(self):
+        return {
+            'messages': self.messages,
+            'turns': self.turns,
+            'merged': self.merged,
+            'pending_users': len(self.pending),
+        }
+
+
+coalescer = Coalescer()
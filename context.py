@@ -0,0 +1,199 @@
+import os
+import re
+import asyncio
+import logging
+from collections import OrderedDict
+
+from scheduler import scheduler
+from schema import TIME_PROJECTION, TURN_PROJECTION
+from utils import async_ollama_client
+
+logger = logging.getLogger('uvicorn')
+
+ROLLING_SUMMARY = os.getenv('ROLLING_SUMMARY', '1') == '1'
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+SUMMARY_WINDOW = int(os.getenv('SUMMARY_WINDOW', '20'))
+SUMMARY_STEP = int(os.getenv('SUMMARY_STEP', '10'))
+
+SUMMARY_PROMPT = """You maintain a running summary of a chat between a user and an assistant.
+Merge the new conversation into the summary so far. Keep names, facts about
+the user, preferences and open questions; drop small talk. Answer with the
+summary only, in the language of the conversation, in at most 200 words."""
+
+wide_chars = re.compile(
+    r'[\u1100-\u11ff\u2e80-\ua4cf\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+tokenizers = {}
+
+
+def bot_setting(name, key, default):
+    return os.getenv(f'{name.upper()}_{key}', default)
+
+
+def load_tokenizer(tokenizer_name):
+    if tokenizer_name not in tokenizers:
+        try:
+            from transformers import AutoTokenizer
+            tokenizers[tokenizer_name] = AutoTokenizer.from_pretrained(tokenizer_name)
+        except Exception:
+            logger.exception(f'failed to load tokenizer {tokenizer_name}, estimating')
+            tokenizers[tokenizer_name] = None
+    return tokenizers[tokenizer_name]
+
+
+class TokenCounter:
+    """Counts tokens with the model's Hugging Face tokenizer when one is
+    configured, otherwise estimates them: one per CJK character and one
+    per four other characters."""
+
+    def __init__(self, tokenizer_name=None):
+        self.tokenizer_name = tokenizer_name
+        self.tokenizer = None
+
+    def count(self, text):
+        if self.tokenizer_name and self.tokenizer is None:
+            self.tokenizer = load_tokenizer(self.tokenizer_name)
+            if self.tokenizer is None:
+                self.tokenizer_name = None
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        wide = len(wide_chars.findall(text))
+        return wide + (len(text) - wide + 3) // 4
+
+
+class Budget:
+
+    def __init__(self, counter, remaining):
+        self.counter = counter
+        self.remaining = remaining
+
+    def take(self, text):
+        n = self.counter.count(text)
+        if n > self.remaining:
+            return False
+        self.remaining -= n
+        return True
+
+
+class ContextBuilder:
+    """Fills a per-bot token budget with optional context in priority order.
+
+    The fixed parts (system prompt, user input) are always sent and counted
+    first. Callers then offer optional context to the budget from most to
+    least important; anything that doesn't fit is skipped, so a long memory
+    doesn't stop a shorter, lower ranked one from being used.
+    """
+
+    def __init__(self, counter, budget):
+        self.counter = counter
+        self.budget = budget
+
+    def start(self, fixed):
+        used = sum(self.counter.count(text) for text in fixed if text)
+        return Budget(self.counter, self.budget - used)
+
+
+class RollingSummary:
+    """Per-user summary of the turns older than the recent window.
+
+    Summaries live in a mongo collection next to the chat log and are
+    extended incrementally: once `step` turns have fallen out of the window
+    since the last refresh, only those turns are merged into the existing
+    summary. Refreshes run in the background after a reply.
+    """
+
+    def __init__(self, summaries, history, summarize, window, step,
+                 max_cached=10000):
+        self.summaries = summaries
+        self.history = history
+        self.summarize = summarize
+        self.window = window
+        self.step = step
+        self.max_cached = max_cached
+        self.cache = OrderedDict()
+        self.refreshing = {}
+        self.refreshes = 0
+
+    async def get(self, user_id):
+        if user_id in self.cache:
+            self.cache.move_to_end(user_id)
+            return self.cache[user_id].get('summary')
+        doc = await self.summaries.find_one({'user_id': user_id}) or {}
+        self.remember(user_id, doc)
+        return doc.get('summary')
+
+    def remember(self, user_id, doc):
+        self.cache[user_id] = doc
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+
+    def schedule(self, user_id):
+        if user_id not in self.refreshing:
+            self.refreshing[user_id] = asyncio.ensure_future(self.refresh(user_id))
+
+    async def refresh(self, user_id):
+        try:
+            doc = await self.summaries.find_one({'user_id': user_id}) or {}
+            cursor = self.history.find({'user_id': user_id}, TIME_PROJECTION)
+            newest = await cursor.sort('t', -1).limit(self.window).to_list(self.window)
+            if len(newest) < self.window:
+                return
+            t = {'$lt': newest[-1]['t']}
+            if doc.get('until') is not None:
+                t['$gt'] = doc['until']
+            cursor = self.history.find({'user_id': user_id, 't': t},
+                                       TURN_PROJECTION)
+            turns = await cursor.sort('t', 1).limit(self.step * 5).to_list(self.step * 5)
+            if len(turns) < self.step:
+                return
+
+            summary = await self.summarize(doc.get('summary'), turns)
+            doc = {
+                'user_id': user_id,
+                'summary': summary,
+                'until': turns[-1]['t'],
+                'turns': doc.get('turns', 0) + len(turns),
+            }
+            await self.summaries.update_one(
+                {'user_id': user_id}, {'$set': doc}, upsert=True)
+            self.remember(user_id, doc)
+            self.refreshes += 1
+        except Exception:
+            logger.exception(f'failed to refresh summary of {user_id}')
+        finally:
+            del self.refreshing[user_id]
+
+
+def create_summarizer(model):
+
+    async def summarize(previous, turns):
+        lines = [f"User: {t['user_input']}\nAssistant: {t['response']}"
+                 for t in turns]
+        content = ''
+        if previous:
+            content += f'Summary so far:\n{previous}\n\n'
+        content += 'New conversation:\n' + '\n\n'.join(lines)
+        messages = [
+            {'role': 'system', 'content': SUMMARY_PROMPT},
+            {'role': 'user', 'content': content},
+        ]
+        # background work, it waits its turn instead of being shed
+        async with scheduler.slot(model, shed=False) as keep_alive:
+            response = await async_ollama_client.chat(
+                model=model, messages=messages, keep_alive=keep_alive)
+        return response['message']['content'].strip()
+
+    return summarize
+
+
+def create_context(name):
+    counter = TokenCounter(bot_setting(name, 'TOKENIZER', None))
+    budget = int(bot_setting(name, 'CONTEXT_TOKEN_BUDGET', CONTEXT_TOKEN_BUDGET))
+    return ContextBuilder(counter, budget)
+
+
+def create_rolling_summary(db, history, model, window=SUMMARY_WINDOW):
+    if not ROLLING_SUMMARY:
+        return None
+    return RollingSummary(db['summaries'], history, create_summarizer(model),
+                          window, SUMMARY_STEP)
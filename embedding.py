@@ -0,0 +1,282 @@
+import os
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger('uvicorn')
+
+BACKENDS = ('torch', 'onnx', 'int8')
+
+
+def load_model(model_name, backend='torch'):
+    # importing sentence_transformers pulls in torch, so defer it as well
+    from sentence_transformers import SentenceTransformer
+    if backend == 'torch':
+        return SentenceTransformer(model_name, device='cpu')
+    if backend == 'onnx':
+        # uint8 quantized export shipped with the model on the hub
+        return SentenceTransformer(
+            model_name,
+            device='cpu',
+            backend='onnx',
+            model_kwargs={'file_name': 'onnx/model_quint8_avx2.onnx'},
+        )
+    if backend == 'int8':
+        import torch
+        model = SentenceTransformer(model_name, device='cpu')
+        return torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8)
+    raise ValueError(f'unknown embedding backend: {backend}')
+
+
+class VectorCache:
+    """Text to vector cache: an in-memory LRU over an on-disk store.
+
+    The disk store is one append-only file of fixed size records
+    (sha1 of model name and text, float32 vector) that is memory-mapped
+    on open, so restarts don't recompute embeddings. A torn trailing
+    record from a crash is ignored.
+    """
+
+    def __init__(self, path, model_name, dim, max_size=10000):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.dtype = np.dtype([('key', 'u1', (20,)), ('vector', '<f4', (dim,))])
+        self.memory = OrderedDict()
+        self.rows = {}
+        self.mmap = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.join(path, model_name.replace('/', '_'))
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'vectors-{dim}.bin')
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size % self.dtype.itemsize:
+            with open(self.path, 'r+b') as f:
+                f.truncate(size - size % self.dtype.itemsize)
+        self.file = open(self.path, 'ab')
+        self.remap()
+        if self.mmap is not None:
+            for i, key in enumerate(self.mmap['key']):
+                self.rows[key.tobytes()] = i
+
+    def remap(self):
+        count = os.path.getsize(self.path) // self.dtype.itemsize
+        if count:
+            self.mmap = np.memmap(self.path, dtype=self.dtype, mode='r',
+                                  shape=(count,))
+
+    def key(self, text):
+        return hashlib.sha1(
+            f'{self.model_name}\0{text}'.encode()).digest()
+
+    def get(self, text):
+        key = self.key(text)
+        with self.lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return vector
+            row = self.rows.get(key)
+            if row is None:
+                self.misses += 1
+                return None
+            if self.mmap is None or row >= len(self.mmap):
+                self.remap()
+            vector = np.array(self.mmap[row]['vector'])
+            self.remember(key, vector)
+            self.hits += 1
+            return vector
+
+    def put(self, text, vector):
+        key = self.key(text)
+        with self.lock:
+            self.remember(key, vector)
+            if key in self.rows:
+                return
+            record = np.zeros(1, dtype=self.dtype)
+            record['key'] = np.frombuffer(key, dtype=np.uint8)
+            record['vector'] = vector
+            self.file.write(record.tobytes())
+            self.file.flush()
+            size = os.fstat(self.file.fileno()).st_size
+            self.rows[key] = size // self.dtype.itemsize - 1
+
+    def remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        self.file.close()
+
+    def stats(self):
+        return {
+            'memory': len(self.memory),
+            'disk': len(self.rows),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class EmbeddingService:
+    """Collects concurrent encode requests into micro-batches.
+
+    A request waits at most max_wait seconds for others to join it, and a
+    batch never grows past max_batch_size texts. Batches are encoded one at
+    a time on a dedicated thread so the model doesn't fight itself for
+    cores. The model is loaded on first use, or by warmup().
+    """
+
+    def __init__(self, model_name, backend='torch', max_batch_size=32,
+                 max_wait=0.005, cache_dir=None, cache_size=10000):
+        self.model_name = model_name
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.model = None
+        self.cache = None
+        self.load_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+        self.batches = 0
+        self.texts = 0
+
+    def load(self):
+        with self.load_lock:
+            if self.model is not None:
+                return self.model
+            model = load_model(self.model_name, self.backend)
+            if self.cache_dir:
+                dim = model.get_sentence_embedding_dimension()
+                self.cache = VectorCache(self.cache_dir, self.model_name, dim,
+                                         self.cache_size)
+            self.model = model
+            return model
+
+    async def load_async(self):
+        if self.model is None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.load)
+
+    async def warmup(self):
+        await self.load_async()
+        await self.submit(['warm up'])
+
+    def encode_batch(self, texts):
+        return self.load().encode(texts, batch_size=self.max_batch_size)
+
+    def lookup(self, texts):
+        vectors = [self.cache.get(text) for text in texts]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        return vectors, missing
+
+    def merge(self, texts, vectors, missing, encoded):
+        for i, vector in zip(missing, encoded):
+            self.cache.put(texts[i], vector)
+            vectors[i] = vector
+        return np.stack(vectors)
+
+    def encode(self, texts, cache=True):
+        self.load()
+        if self.cache is None or not cache:
+            return self.encode_batch(texts)
+        vectors, missing = self.lookup(texts)
+        encoded = []
+        if missing:
+            encoded = self.encode_batch([texts[i] for i in missing])
+        return self.merge(texts, vectors, missing, encoded)
+
+    async def encode_async(self, texts, cache=True):
+        await self.load_async()
+        if self.cache is None or not cache:
+            return await self.submit(texts)
+        vectors, missing = self.lookup(texts)
+        encoded = []
+        if missing:
+            encoded = await self.submit([texts[i] for i in missing])
+        return self.merge(texts, vectors, missing, encoded)
+
+    async def submit(self, texts):
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((texts, future))
+        return await future
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        size = len(batch[0][0])
+        deadline = loop.time() + self.max_wait
+        while size < self.max_batch_size:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self.queue.get_nowait()
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            texts = [text for item, _ in batch for text in item]
+            try:
+                vectors = await loop.run_in_executor(
+                    self.executor, self.encode_batch, texts)
+            except Exception as e:
+                logger.exception('embedding batch failed')
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.texts += len(texts)
+            i = 0
+            for item, future in batch:
+                if not future.done():
+                    future.set_result(vectors[i:i + len(item)])
+                i += len(item)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.executor.shutdown(wait=False)
+        if self.cache is not None:
+            self.cache.close()
+
+    def stats(self):
+        stats = {
+            'backend': self.backend,
+            'loaded': self.model is not None,
+            'batches': self.batches,
+            'texts': self.texts,
+            'avg_batch_size': self.texts / self.batches if self.batches else 0.0,
+        }
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
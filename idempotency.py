@@ -0,0 +1,157 @@
+import os
+import time
+import logging
+from datetime import datetime, timezone
+from collections import OrderedDict
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger('uvicorn')
+
+# memory: per process, mongo: shared by every worker
+IDEMPOTENCY_STORE = os.getenv('IDEMPOTENCY_STORE', 'memory')
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_SIZE = int(os.getenv('IDEMPOTENCY_SIZE', '100000'))
+# drop every redelivered event, even ones this store hasn't seen
+DROP_REDELIVERIES = os.getenv('DROP_REDELIVERIES', '0') == '1'
+
+
+class MemoryStore:
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.keys = OrderedDict()
+
+    async def claim(self, key):
+        now = time.monotonic()
+        while self.keys:
+            oldest, expires = next(iter(self.keys.items()))
+            if expires > now and len(self.keys) < self.max_size:
+                break
+            del self.keys[oldest]
+        if key in self.keys:
+            return False
+        self.keys[key] = now + self.ttl
+        return True
+
+    async def release(self, key):
+        self.keys.pop(key, None)
+
+    async def start(self):
+        pass
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class MongoStore:
+    """Claims event ids by inserting them as _id, expired by a TTL index."""
+
+    def __init__(self, collection, ttl):
+        self.collection = collection
+        self.ttl = ttl
+
+    async def claim(self, key):
+        try:
+            await self.collection.insert_one(
+                {'_id': key, 't': datetime.now(timezone.utc)})
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def release(self, key):
+        await self.collection.delete_one({'_id': key})
+
+    async def start(self):
+        try:
+            await self.collection.create_index('t', expireAfterSeconds=int(self.ttl))
+        except Exception:
+            logger.exception('failed to create the webhook event ttl index')
+
+    def __len__(self):
+        return 0
+
+
+class Deduplicator:
+    """Drops webhook events that were already taken by a handler.
+
+    LINE retries a webhook that didn't answer in time, marking the events
+    with deliveryContext.isRedelivery but keeping their webhookEventId.
+    The id is claimed before anything else is done for the event and
+    released again if the handler fails, so a later retry still gets a
+    chance.
+    """
+
+    def __init__(self, store, drop_redeliveries=False):
+        self.store = store
+        self.drop_redeliveries = drop_redeliveries
+        self.accepted = 0
+        self.skipped = 0
+        self.redeliveries = 0
+
+    async def claim(self, event):
+        key = getattr(event, 'webhook_event_id', None)
+        context = getattr(event, 'delivery_context', None)
+        redelivery = bool(context and context.is_redelivery)
+        self.redeliveries += redelivery
+        if redelivery and self.drop_redeliveries:
+            self.skipped += 1
+            return False
+        if key is None:
+            self.accepted += 1
+            return True
+        try:
+            claimed = await self.store.claim(key)
+        except Exception:
+            # better a rare duplicate than a lost message
+            logger.exception(f'failed to claim webhook event {key}')
+            claimed = True
+        if claimed:
+            self.accepted += 1
+        else:
+            self.skipped += 1
+            logger.info(f'skipping duplicate webhook event {key} (redelivery={redelivery})')
+        return claimed
+
+    async def release(self, event):
+        key = getattr(event, 'webhook_event_id', None)
+        if key is None:
+            return
+        try:
+            await self.store.release(key)
+        except Exception:
+            logger.exception(f'failed to release webhook event {key}')
+
+    def guard(self, handle_event):
+
+        async def handle(event):
+            try:
+                await handle_event(event)
+            except BaseException:
+                await self.release(event)
+                raise
+
+        return handle
+
+    def stats(self):
+        return {
+            'store': IDEMPOTENCY_STORE,
+            'accepted': self.accepted,
+            'skipped': self.skipped,
+            'redeliveries': self.redeliveries,
+            'tracked': len(self.store),
+        }
+
+
+def create_deduplicator():
+    if IDEMPOTENCY_STORE == 'mongo':
+        from utils import get_async_mongo_client
+        collection = get_async_mongo_client()['linebots']['webhook_events']
+        store = MongoStore(collection, IDEMPOTENCY_TTL)
+    else:
+        store = MemoryStore(IDEMPOTENCY_SIZE, IDEMPOTENCY_TTL)
+    return Deduplicator(store, DROP_REDELIVERIES)
+
+
+deduplicator = create_deduplicator()
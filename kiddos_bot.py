@@ -1,4 +1,6 @@
 import os
+import time
+import asyncio
 import logging
 from datetime import datetime
 import requests
@@ -8,11 +10,10 @@ from fastapi import APIRouter
 from fastapi import Request, HTTPException
 
 from linebot.v3.webhook import WebhookParser
-from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, Configuration, ReplyMessageRequest, TextMessage
+from linebot.v3.messaging import ReplyMessageRequest, TextMessage
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 import configparser
-from langchain_community.tools.tavily_search import TavilySearchResults
 from langchain_experimental.tools.python.tool import PythonREPLTool
 from langchain_community.tools import WikipediaQueryRun
 from langchain_community.utilities import WikipediaAPIWrapper
@@ -24,7 +25,19 @@ from langchain.agents import create_react_agent
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_community.llms import Ollama
 
+from idempotency import deduplicator
+from scheduler import Busy, scheduler
+from answer_cache import create_answer_cache
+from agent import AsyncAgent, AsyncTool
+from calculator import evaluate
+from tracing import span, trace
+from logs import log_turn
+from utils import ChannelApi, async_ollama_client, http_client
+
 MODEL = 'gemma'
+# async: the budgeted agent in agent.py, langchain: the AgentExecutor
+AGENT = os.getenv('KIDDOS_AGENT', 'async')
+BUSY_REPLY = 'Sorry, too many people are asking me questions right now. Please try again in a moment.'
 
 
 @tool
@@ -35,8 +48,8 @@ def calculator_tool(query: str) -> str:
     this tool will return 149212404
   """
   try:
-    return eval(query)
-  except Exception:
+    return evaluate(query)
+  except (ValueError, ArithmeticError):
     return ''
 
 
@@ -74,7 +87,7 @@ def conversation_tool(query: str) -> str:
         message = body.get("message", "")
         content = message.get("content", "")
         output += content
-    logger.info(f'conversation output: {output}')
+    log_turn(logger, 'kiddos-bot', user=query, reply=output)
     return output
   except Exception:
     return "I don't know the answer"
@@ -87,30 +100,13 @@ config.read('config.ini')
 # bot
 bot_channel_secret = config.get('kiddos-bot', 'LINE_CHANNEL_SECRET')
 bot_channel_access_token = config.get('kiddos-bot', 'LINE_CHANNEL_ACCESS_TOKEN')
-bot_configuration = Configuration(access_token=bot_channel_access_token)
-bot_async_api_client = AsyncApiClient(bot_configuration)
-bot_line_api = AsyncMessagingApi(bot_async_api_client)
+bot_line_api = ChannelApi(bot_channel_access_token)
 bot_parser = WebhookParser(bot_channel_secret)
 
 os.environ['TAVILY_API_KEY'] = config.get('travily', 'TAVILY_API_KEY')
-travily_search_tool = TavilySearchResults()
-python_repl_tool = PythonREPLTool()
-api_wrapper = WikipediaAPIWrapper(top_k_results=2, doc_content_chars_max=1000)
-wiki_tool = WikipediaQueryRun(api_wrapper=api_wrapper)
 os.environ['GOOGLE_CSE_ID'] = config.get('google', 'GOOGLE_CSE_ID')
 os.environ['GOOGLE_API_KEY'] = config.get('google', 'GOOGLE_API_KEY')
 
-google_search = GoogleSearchAPIWrapper()
-
-google_search_tool = Tool(
-  name="google_search",
-  description="Search Google for recent results.",
-  func=google_search.run,
-)
-
-llm = Ollama(model=MODEL, temperature=0.1)
-tools = [conversation_tool, calculator_tool, python_repl_tool, wiki_tool, google_search_tool]
-
 template = """[INST] Answer the following questions as best you can. You have access to the following tools:
 
 {tools}
@@ -144,20 +140,177 @@ Instruction: {input}
 Thought: {agent_scratchpad}
 [/INST]
 """
-prompt = ChatPromptTemplate.from_template(template)
+agent_executor = None
+answer_cache = create_answer_cache()
+
+
+def get_agent_executor():
+  # the tools and agent are built on the first message, not at import
+  global agent_executor
+  if agent_executor is not None:
+    return agent_executor
+
+  python_repl_tool = PythonREPLTool()
+  api_wrapper = WikipediaAPIWrapper(top_k_results=2, doc_content_chars_max=1000)
+  wiki_tool = WikipediaQueryRun(api_wrapper=api_wrapper)
+  google_search = GoogleSearchAPIWrapper()
+  google_search_tool = Tool(
+    name="google_search",
+    description="Search Google for recent results.",
+    func=google_search.run,
+  )
+
+  llm = Ollama(model=MODEL, temperature=0.1)
+  tools = [conversation_tool, calculator_tool, python_repl_tool, wiki_tool, google_search_tool]
+  prompt = ChatPromptTemplate.from_template(template)
+  agent = create_react_agent(llm, tools, prompt)
+  agent_executor = AgentExecutor.from_agent_and_tools(
+    agent=agent,
+    tools=tools,
+    handle_parsing_errors=True,
+    return_intermediate_steps=True,
+    verbose=True,
+  )
+  return agent_executor
+
+
+async def calculate(query):
+  return evaluate(query)
+
+
+async def current_time(query):
+  return datetime.now().strftime("%Y-%m-%d, %H:%M:%S")
+
+
+async def converse(query):
+  async with scheduler.slot(MODEL) as keep_alive:
+    response = await async_ollama_client.generate(
+      model=MODEL,
+      system="You are a helpful AI assistant who answer user's question.",
+      prompt=query,
+      options={'temperature': 0.96},
+      keep_alive=keep_alive,
+    )
+  return response['response']
+
+
+async def search_wikipedia(query, top_k_results=2, doc_content_chars_max=1000):
+  url = 'https://en.wikipedia.org/w/api.php'
+  r = await http_client.get(url, params={
+    'action': 'query',
+    'list': 'search',
+    'srsearch': query,
+    'srlimit': top_k_results,
+    'format': 'json',
+  })
+  r.raise_for_status()
+  titles = [result['title'] for result in r.json()['query']['search']]
+  if not titles:
+    return 'No good Wikipedia Search Result was found'
+  r = await http_client.get(url, params={
+    'action': 'query',
+    'prop': 'extracts',
+    'exintro': 1,
+    'explaintext': 1,
+    'titles': '|'.join(titles),
+    'format': 'json',
+  })
+  r.raise_for_status()
+  pages = r.json()['query']['pages'].values()
+  summaries = [f"Page: {page['title']}\nSummary: {page.get('extract', '')}" for page in pages]
+  return '\n\n'.join(summaries)[:doc_content_chars_max * top_k_results]
+
+
+async def search_google(query, k=10):
+  r = await http_client.get('https://www.googleapis.com/customsearch/v1', params={
+    'key': os.environ['GOOGLE_API_KEY'],
+    'cx': os.environ['GOOGLE_CSE_ID'],
+    'q': query,
+    'num': k,
+  })
+  r.raise_for_status()
+  snippets = [item['snippet'] for item in r.json().get('items', []) if 'snippet' in item]
+  if not snippets:
+    return 'No good Google Search Result was found'
+  return ' '.join(snippets)
+
+
+async def run_python(query):
+  return await asyncio.to_thread(PythonREPLTool().run, query)
+
+
+async_template = template.replace(
+  '3. There should always be a "Observation:" after "Action:"\n',
+  '3. There should always be a "Observation:" after "Action:"\n'
+  '4. Actions that don\'t need each other\'s results can be listed one after another before the Observation\n')
+async_agent = AsyncAgent([
+  AsyncTool('conversation_tool', 'this tool can answer conversational question from user',
+            converse, timeout=20, ttl=3600),
+  AsyncTool('calculator_tool', 'Perform math operations. Example: Query: 3102 * 48102, '
+            'this tool will return 149212404', calculate, timeout=1, ttl=86400),
+  AsyncTool('current_time_tool', 'Get current time', current_time),
+  AsyncTool('Python_REPL', 'A Python shell. Use this to execute python commands. '
+            'Input should be a valid python command.', run_python),
+  AsyncTool('wikipedia', 'A wrapper around Wikipedia. Useful for when you need to answer '
+            'general questions about people, places, companies, facts, historical events, '
+            'or other subjects. Input should be a search query.', search_wikipedia, ttl=86400),
+  AsyncTool('google_search', 'Search Google for recent results.', search_google, ttl=600),
+], async_template)
+
+
+async def llm(prompt):
+  # a slot per step, the tools in between don't hold the model
+  async with scheduler.slot(MODEL) as keep_alive:
+    response = await async_ollama_client.generate(
+      model=MODEL,
+      prompt=prompt,
+      options={'temperature': 0.1, 'stop': ['\nObservation']},
+      keep_alive=keep_alive,
+    )
+  return response['response']
+
+
+async def run_agent(user_input):
+  if AGENT == 'langchain':
+    # one slot for the whole run, every step calls the model from the thread
+    async with scheduler.slot(MODEL):
+      return await asyncio.to_thread(get_agent_executor().invoke, {'input': user_input})
+  return await async_agent.run(user_input, llm)
+
+
+async def answer(user_input):
+  vector = None
+  if answer_cache is not None:
+    with span('answer_cache'):
+      output, vector = await answer_cache.get(user_input)
+    if output is not None:
+      return TextMessage(text=output)
+  start = time.monotonic()
+  try:
+    with span('agent'):
+      result = await run_agent(user_input)
+  except Busy:
+    return TextMessage(text=BUSY_REPLY)
+  log_turn(logger, 'kiddos-bot', user=user_input, reply=result['output'])
+  if answer_cache is not None:
+    tools = [action.tool for action, _ in result.get('intermediate_steps', [])]
+    answer_cache.put(user_input, vector, result['output'], tools,
+                     time.monotonic() - start)
+  return TextMessage(text=result['output'])
 
-tool_names = [tool.name for tool in tools]
-agent = create_react_agent(llm, tools, prompt)
-agent_executor = AgentExecutor.from_agent_and_tools(
-  agent=agent,
-  tools=tools,
-  handle_parsing_errors=True,
-  verbose=True,
-)
 
 router = APIRouter()
 
 
+@router.get('/kiddos-bot/stats')
+async def stats():
+  return {
+    'answers': answer_cache.stats() if answer_cache is not None else None,
+    'agent': async_agent.stats(),
+    'scheduler': scheduler.stats(),
+  }
+
+
 @router.post("/kiddos-bot")
 async def handle_callback(request: Request):
   signature = request.headers['X-Line-Signature']
@@ -176,10 +329,17 @@ async def handle_callback(request: Request):
       continue
     if not isinstance(event.message, TextMessageContent):
       continue
+    if not await deduplicator.claim(event):
+      continue
 
-    user_input = event.message.text
-    result = agent_executor.invoke({'input': user_input})
-    message = TextMessage(text=result['output'])
-    request = ReplyMessageRequest(reply_token=event.reply_token, messages=[message])
-    await bot_line_api.reply_message(request)
+    try:
+      user_input = event.message.text
+      with trace('kiddos-bot'):
+        message = await answer(user_input)
+        request = ReplyMessageRequest(reply_token=event.reply_token, messages=[message])
+        with span('reply'):
+          await bot_line_api.reply_message(request)
+    except Exception:
+      await deduplicator.release(event)
+      raise
   return 'OK'
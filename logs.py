@@ -0,0 +1,132 @@
+import os
+import sys
+import gzip
+import json
+import queue
+import atexit
+import shutil
+import hashlib
+import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+from dotenv import load_dotenv
+# uvicorn --log-config imports this before main.py has loaded .env, the
+# LOG_* and TRACE_* settings below and in tracing are read at import
+load_dotenv()
+
+from tracing import current_trace, metrics
+
+# size: rotate at LOG_MAX_BYTES, otherwise a TimedRotatingFileHandler `when`
+LOG_ROTATE = os.getenv('LOG_ROTATE', 'size')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(50 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '10'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# hash, truncate or full; sampled traces are always logged in full
+LOG_PROMPTS = os.getenv('LOG_PROMPTS', 'hash')
+LOG_PROMPT_CHARS = int(os.getenv('LOG_PROMPT_CHARS', '200'))
+
+CONSOLE_FORMAT = '[%(asctime)s.%(msecs)03d] %(levelname)s [%(thread)d] - %(message)s'
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; extra= fields become keys."""
+
+    def format(self, record):
+        data = {
+            't': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.thread,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_FIELDS:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def gzip_namer(name):
+    return name + '.gz'
+
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def create_file_handler(filename, rotate=LOG_ROTATE, max_bytes=LOG_MAX_BYTES,
+                        backup_count=LOG_BACKUP_COUNT):
+    if rotate == 'size':
+        handler = RotatingFileHandler(filename, maxBytes=max_bytes,
+                                      backupCount=backup_count, encoding='utf-8')
+    else:
+        handler = TimedRotatingFileHandler(filename, when=rotate,
+                                           backupCount=backup_count, encoding='utf-8')
+    handler.namer = gzip_namer
+    handler.rotator = gzip_rotator
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+class QueueLogHandler(QueueHandler):
+    """Hands records to a writer thread that owns the file and console.
+
+    Logging from the event loop only formats the message and puts it on a
+    bounded queue; when the writer falls behind, records are dropped and
+    counted instead of blocking the loop. The file gets JSON lines and is
+    rotated and gzipped by the writer thread.
+    """
+
+    def __init__(self, filename, console=True, queue_size=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(queue_size))
+        self.dropped = 0
+        handlers = [create_file_handler(filename)]
+        if console:
+            stream = logging.StreamHandler(sys.stderr)
+            stream.setFormatter(logging.Formatter(CONSOLE_FORMAT, '%Y-%m-%d %H:%M:%S'))
+            handlers.append(stream)
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def prepare(self, record):
+        # keep the extra fields, unlike QueueHandler.prepare
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc('linebots_log_dropped_total', ())
+
+
+def redact(text):
+    """A prompt or reply as it should go to the log."""
+    t = current_trace.get()
+    if LOG_PROMPTS == 'full' or (t is not None and t.sampled):
+        return text
+    if LOG_PROMPTS == 'truncate':
+        return text if len(text) <= LOG_PROMPT_CHARS else text[:LOG_PROMPT_CHARS] + '…'
+    return {'sha1': hashlib.sha1(text.encode()).hexdigest()[:12], 'chars': len(text)}
+
+
+def log_turn(logger, bot, **texts):
+    fields = {key: redact(value) for key, value in texts.items() if value is not None}
+    t = current_trace.get()
+    if t is not None:
+        fields['trace'] = t.id
+    logger.info(f'{bot} turn', extra={'bot': bot, **fields})
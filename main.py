@@ -1,12 +1,81 @@
 import os
+import asyncio
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+load_dotenv()
+
 from fastapi import FastAPI
-import mittens
-import yoshi
+from fastapi.responses import PlainTextResponse
 # import pastor
+import webhook_queue
+import readiness
+from coalesce import coalescer
+from idempotency import deduplicator
+import bots
+from write_behind import writer
+from streaming import stream_stats
+from prompt import prompt_stats
+from scheduler import scheduler
+import tracing
+import utils
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    if writer is not None:
+        await writer.start()
+    await deduplicator.store.start()
+    for bot in bots.registry.values():
+        await bot.startup()
+    models = {bot.model for bot in bots.registry.values() if bot.model}
+    warmup = asyncio.create_task(readiness.warmup(sorted(models)))
+    yield
+    warmup.cancel()
+    # queued events go to the coalescer, whose turns go to the writer
+    await webhook_queue.pool.close(webhook_queue.WEBHOOK_DRAIN_TIMEOUT)
+    await coalescer.close()
+    if writer is not None:
+        await writer.close()
+    await utils.http_client.aclose()
+    await utils.line_api.api_client.close()
+    await utils.embedding_service.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 dir = os.path.dirname(__file__)
-app.include_router(mittens.router)
-app.include_router(yoshi.router)
 # app.include_router(pastor.router)
+app.include_router(readiness.router)
+# POST /{name} for every bot in bots.ini, keep it last
+app.include_router(bots.router)
+
+
+@app.get('/stats')
+async def stats():
+    return {
+        'queue': webhook_queue.pool.stats(),
+        'idempotency': deduplicator.stats(),
+        'coalesce': coalescer.stats(),
+        'scheduler': scheduler.stats(),
+        'profiles': utils.profile_cache.stats(),
+        'embeddings': utils.embedding_service.stats(),
+        'write_behind': writer.stats() if writer is not None else None,
+        'streaming': stream_stats.stats(),
+        'prompts': prompt_stats.stats(),
+        'memory': {
+            name: bot.memory.stats()
+            for name, bot in bots.registry.items()
+            if bot.memory is not None
+        },
+    }
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    return tracing.metrics.render()
+
+
+@app.get('/traces')
+async def traces():
+    return list(tracing.traces)
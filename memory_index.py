@@ -0,0 +1,232 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger('uvicorn')
+
+MEMORY_INDEX = os.getenv('MEMORY_INDEX', '0') == '1'
+MEMORY_INDEX_DIR = os.getenv('MEMORY_INDEX_DIR', 'data/memory')
+MEMORY_INDEX_DTYPE = os.getenv('MEMORY_INDEX_DTYPE', 'float32')
+MEMORY_INDEX_USERS = int(os.getenv('MEMORY_INDEX_USERS', '1000'))
+
+
+def record_dtype(dim, dtype):
+    if dtype == 'int8':
+        return np.dtype([('scale', '<f4'), ('vector', 'i1', (dim,))])
+    if dtype == 'float32':
+        return np.dtype([('vector', '<f4', (dim,))])
+    raise ValueError(f'unknown memory index dtype: {dtype}')
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class Partition:
+    """One user's memories: a memory-mapped matrix plus their documents.
+
+    vectors.bin holds fixed size records (float32, or int8 with a per-row
+    scale) and docs.jsonl the matching id, document and metadata, both
+    append-only. Anything past the last complete pair is dropped on load.
+    """
+
+    def __init__(self, directory, dim, dtype):
+        os.makedirs(directory, exist_ok=True)
+        self.dtype = record_dtype(dim, dtype)
+        self.quantized = dtype == 'int8'
+        self.vectors_path = os.path.join(directory, 'vectors.bin')
+        self.docs_path = os.path.join(directory, 'docs.jsonl')
+        self.ids = []
+        self.id_set = set()
+        self.documents = []
+        self.metadatas = []
+        self.mmap = None
+        self.stale = True
+        self.read()
+
+    def read(self):
+        torn = False
+        if os.path.exists(self.docs_path):
+            with open(self.docs_path, 'rb') as f:
+                data = f.read()
+            complete = data[:data.rfind(b'\n') + 1]
+            torn = len(complete) != len(data)
+            for line in complete.splitlines():
+                doc = json.loads(line)
+                self.ids.append(doc['id'])
+                self.documents.append(doc['document'])
+                self.metadatas.append(doc['metadata'])
+        rows = 0
+        if os.path.exists(self.vectors_path):
+            rows = os.path.getsize(self.vectors_path) // self.dtype.itemsize
+
+        count = min(rows, len(self.ids))
+        if torn or len(self.ids) > count:
+            del self.ids[count:], self.documents[count:], self.metadatas[count:]
+            with open(self.docs_path, 'w') as f:
+                for i in range(count):
+                    f.write(self.dumps(self.ids[i], self.documents[i],
+                                       self.metadatas[i]))
+        if os.path.exists(self.vectors_path):
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(count * self.dtype.itemsize)
+        self.id_set = set(self.ids)
+        self.remap()
+
+    def remap(self):
+        self.mmap = None
+        if self.ids:
+            self.mmap = np.memmap(self.vectors_path, dtype=self.dtype,
+                                  mode='r', shape=(len(self.ids),))
+
+    def dumps(self, id, document, metadata):
+        doc = {'id': id, 'document': document, 'metadata': metadata}
+        return json.dumps(doc, ensure_ascii=False) + '\n'
+
+    def append(self, ids, vectors, documents, metadatas):
+        keep = [i for i, id in enumerate(ids) if id not in self.id_set]
+        if not keep:
+            return
+        vectors = normalize([vectors[i] for i in keep])
+        records = np.zeros(len(keep), dtype=self.dtype)
+        if self.quantized:
+            scale = np.abs(vectors).max(axis=1) / 127
+            scale[scale == 0] = 1
+            records['scale'] = scale
+            records['vector'] = np.round(vectors / scale[:, None])
+        else:
+            records['vector'] = vectors
+
+        # vectors first, so a crash in between leaves a row to trim on load
+        with open(self.vectors_path, 'ab') as f:
+            f.write(records.tobytes())
+        with open(self.docs_path, 'a') as f:
+            for i in keep:
+                f.write(self.dumps(ids[i], documents[i], metadatas[i]))
+        for i in keep:
+            self.ids.append(ids[i])
+            self.id_set.add(ids[i])
+            self.documents.append(documents[i])
+            self.metadatas.append(metadatas[i])
+        self.remap()
+
+    def search(self, vector, n_results):
+        result = {'ids': [[]], 'documents': [[]], 'metadatas': [[]],
+                  'distances': [[]]}
+        if self.mmap is None:
+            return result
+
+        query = normalize(vector)
+        if self.quantized:
+            scores = (self.mmap['vector'] @ query) * self.mmap['scale']
+        else:
+            scores = self.mmap['vector'] @ query
+        k = min(n_results, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        for i in top:
+            result['ids'][0].append(self.ids[i])
+            result['documents'][0].append(self.documents[i])
+            result['metadatas'][0].append(self.metadatas[i])
+            result['distances'][0].append(float(1 - scores[i]))
+        return result
+
+
+class UserMemoryIndex:
+    """In-process chat memory for one bot, partitioned by user_id.
+
+    Partitions are loaded from their shard files on first use, caught up
+    with the Chroma collection (which stays the durable source) and
+    evicted least recently used. Results use chroma's query layout so they
+    can be passed to chat_history_items.
+    """
+
+    def __init__(self, path, name, dtype='float32', max_users=1000):
+        self.directory = os.path.join(path, name)
+        self.dtype = dtype
+        self.max_users = max_users
+        self.partitions = OrderedDict()
+        self.loading = {}
+        self.loads = 0
+        self.evictions = 0
+        self.synced = 0
+
+    def partition_dir(self, user_id):
+        digest = hashlib.sha1(user_id.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    async def get_partition(self, chroma, user_id, dim):
+        partition = self.partitions.get(user_id)
+        if partition is not None:
+            self.partitions.move_to_end(user_id)
+            if not partition.stale:
+                return partition
+
+        task = self.loading.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self.load(chroma, user_id, dim))
+            self.loading[user_id] = task
+        return await asyncio.shield(task)
+
+    async def load(self, chroma, user_id, dim):
+        try:
+            partition = self.partitions.get(user_id)
+            if partition is None:
+                partition = Partition(self.partition_dir(user_id), dim,
+                                      self.dtype)
+                self.loads += 1
+            await self.sync(chroma, user_id, partition)
+            self.partitions[user_id] = partition
+            self.partitions.move_to_end(user_id)
+            while len(self.partitions) > self.max_users:
+                self.partitions.popitem(last=False)
+                self.evictions += 1
+            return partition
+        finally:
+            del self.loading[user_id]
+
+    async def sync(self, chroma, user_id, partition):
+        try:
+            result = await chroma.get(where={'user_id': user_id}, include=[])
+            missing = [id for id in result['ids'] if id not in partition.id_set]
+            if missing:
+                result = await chroma.get(
+                    ids=missing,
+                    include=['embeddings', 'documents', 'metadatas'])
+                partition.append(result['ids'], result['embeddings'],
+                                 result['documents'], result['metadatas'])
+                self.synced += len(missing)
+            partition.stale = False
+        except Exception:
+            # serve what is on disk, and try to catch up on the next turn
+            logger.exception(f'failed to sync memory of {user_id} from chroma')
+
+    async def query(self, chroma, user_id, vector, n_results=10):
+        partition = await self.get_partition(chroma, user_id, len(vector))
+        return partition.search(vector, n_results)
+
+    async def add(self, chroma, user_id, ids, vectors, documents, metadatas):
+        partition = await self.get_partition(chroma, user_id, len(vectors[0]))
+        partition.append(ids, vectors, documents, metadatas)
+
+    def stats(self):
+        return {
+            'users': len(self.partitions),
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'synced': self.synced,
+        }
+
+
+def create_memory_index(name):
+    if not MEMORY_INDEX:
+        return None
+    return UserMemoryIndex(MEMORY_INDEX_DIR, name, MEMORY_INDEX_DTYPE,
+                           MEMORY_INDEX_USERS)
@@ -0,0 +1,84 @@
+import os
+import logging
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from collections import deque
+
+from tracing import record_generation
+
+logger = logging.getLogger('uvicorn')
+
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+
+
+class PromptBuilder:
+    """Builds system prompts that keep the persona as a byte-stable prefix.
+
+    Ollama can only reuse its KV cache for the longest prefix shared with
+    the previous request, so the persona goes first, untouched, followed by
+    the parts that change from user to user and from turn to turn: the
+    user's name, the rolling summary, retrieved memories and the time
+    (to the minute).
+    """
+
+    def __init__(self, persona, user_template, history_prompt=None,
+                 time_template=None, time_zone='Asia/Taipei',
+                 summary_prompt='Summary of your earlier conversations:'):
+        self.persona = persona
+        self.user_template = user_template
+        self.history_prompt = history_prompt
+        self.time_template = time_template
+        self.summary_prompt = summary_prompt
+        self.time_zone = ZoneInfo(time_zone)
+
+    def build(self, user_name, chat_history=None, summary=None):
+        parts = [self.persona, self.user_template.format(user_name=user_name)]
+        if summary:
+            parts.append(self.summary_prompt + '\n' + summary)
+        if chat_history:
+            parts.append(self.history_prompt + '\n' + chat_history)
+        if self.time_template:
+            t = datetime.now(self.time_zone).strftime('%Y-%m-%d %H:%M')
+            parts.append(self.time_template.format(time=t))
+        return '\n\n'.join(parts) + '\n'
+
+
+class PromptStats:
+    """Keeps Ollama's prompt_eval_count/duration per bot.
+
+    A prompt whose prefix was served from the KV cache only reports the
+    tokens that actually had to be evaluated, so a low count against a long
+    persona means the cache was hit.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.bots = {}
+
+    def record(self, bot, response):
+        record_generation(bot, response)
+        count = response.get('prompt_eval_count')
+        duration = response.get('prompt_eval_duration')
+        if count is None or duration is None:
+            return
+        samples = self.bots.setdefault(bot, deque(maxlen=self.window))
+        samples.append((count, duration / 1e6))
+        logger.info(f'{bot} prompt_eval_count={count} '
+                    f'prompt_eval_duration={duration / 1e6:.1f}ms')
+
+    def stats(self):
+        result = {}
+        for bot, samples in self.bots.items():
+            counts = [count for count, _ in samples]
+            durations = [duration for _, duration in samples]
+            result[bot] = {
+                'requests': len(samples),
+                'last_prompt_eval_count': counts[-1],
+                'last_prompt_eval_ms': durations[-1],
+                'avg_prompt_eval_count': sum(counts) / len(counts),
+                'avg_prompt_eval_ms': sum(durations) / len(durations),
+            }
+        return result
+
+
+prompt_stats = PromptStats()
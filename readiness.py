@@ -0,0 +1,63 @@
+import os
+import time
+import asyncio
+import logging
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+import utils
+from s2t import converter
+from scheduler import scheduler
+
+logger = logging.getLogger('uvicorn')
+
+WARMUP = os.getenv('WARMUP', '1') == '1'
+
+router = APIRouter()
+
+state = {
+    'ready': False,
+    'started': time.monotonic(),
+    'steps': {},
+}
+
+
+async def warmup_step(name, coro):
+    start = time.monotonic()
+    try:
+        await coro
+        state['steps'][name] = round(time.monotonic() - start, 3)
+    except Exception as e:
+        # a failed step only costs latency on the first request, keep going
+        logger.exception(f'warm up step {name} failed')
+        state['steps'][name] = f'failed: {e}'
+
+
+async def load_model(model):
+    # an empty prompt makes ollama load the model without generating
+    async with scheduler.slot(model, shed=False) as keep_alive:
+        await utils.async_ollama_client.generate(
+            model=model, prompt='', keep_alive=keep_alive)
+
+
+async def warmup(models):
+    if WARMUP:
+        await warmup_step('embedder', utils.embedding_service.warmup())
+        await warmup_step('s2t', asyncio.to_thread(converter.load))
+        for model in models:
+            await warmup_step(f'ollama:{model}', load_model(model))
+    state['ready'] = True
+    state['ready_after'] = round(time.monotonic() - state['started'], 3)
+    logger.info(f'ready after {state["ready_after"]}s: {state["steps"]}')
+
+
+@router.get('/ready')
+async def ready():
+    status_code = 200 if state['ready'] else 503
+    content = {
+        'ready': state['ready'],
+        'steps': state['steps'],
+        'ready_after': state.get('ready_after'),
+    }
+    return JSONResponse(content, status_code=status_code)
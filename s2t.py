@@ -0,0 +1,189 @@
+import os
+import re
+import pickle
+import logging
+import threading
+
+logger = logging.getLogger('uvicorn')
+
+S2T_CACHE_PATH = os.getenv('S2T_CACHE_PATH', 'data/s2t.pickle')
+DICTIONARIES = ['STPhrases.txt', 'STCharacters.txt']
+
+# the sentence separators opencc-python-reimplemented splits on, no
+# dictionary entry spans them
+separators = re.compile(
+    r'(\s+|-|,|\.|\?|!|\*|　|，|。|、|；|：|？|！|…|“|”|‘|’|『|』|「|」|﹁|﹂|—|－|（|）|《|》|〈|〉|～|．|／|＼|︒|︑|︔|︓|︿|﹀|︹|︺|︙|︐|［|﹇|］|﹈|︕|︖|︰|︳|︴|︽|︾|︵|︶|｛|︷|｝|︸|﹃|﹄|【|︻|】|︼)')
+
+
+def dictionary_dir():
+    import opencc
+    return os.path.join(os.path.dirname(opencc.__file__), 'dictionary')
+
+
+def read_dictionary(path):
+    table = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            key, value = line.strip().split('\t')
+            # several candidates, opencc uses the first one
+            table[key] = value.split(' ')[0]
+    return table
+
+
+class S2TConverter:
+    """Simplified to traditional conversion with the output of OpenCC('s2t')
+    from opencc-python-reimplemented, which this reads its dictionaries from.
+
+    That converter splits the text at separators and, within each part,
+    repeatedly replaces the longest phrase (leftmost on ties) that doesn't
+    overlap an earlier replacement, then maps the remaining characters one
+    by one. Here the phrase candidates come from walking a prefix table
+    from every position, the replacements are picked in (longest,
+    leftmost) order, and the characters in between go through
+    str.translate. The compiled tables are cached in S2T_CACHE_PATH.
+    """
+
+    def __init__(self, cache_path=S2T_CACHE_PATH):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.phrases = None
+
+    def stamp(self, directory):
+        stamp = []
+        for name in DICTIONARIES:
+            st = os.stat(os.path.join(directory, name))
+            stamp.append((name, st.st_size, st.st_mtime_ns))
+        return stamp
+
+    def compile(self, directory):
+        phrases = read_dictionary(os.path.join(directory, 'STPhrases.txt'))
+        characters = read_dictionary(os.path.join(directory, 'STCharacters.txt'))
+        # every prefix of a phrase -> whether it is a phrase itself
+        prefixes = {key[:i]: False for key in phrases for i in range(1, len(key))}
+        prefixes.update((key, True) for key in phrases)
+        return {
+            'phrases': phrases,
+            'prefixes': prefixes,
+            'characters': str.maketrans(characters),
+        }
+
+    def load(self):
+        with self.lock:
+            if self.phrases is not None:
+                return
+            directory = dictionary_dir()
+            stamp = self.stamp(directory)
+            tables = None
+            if self.cache_path and os.path.exists(self.cache_path):
+                try:
+                    with open(self.cache_path, 'rb') as f:
+                        cached = pickle.load(f)
+                    if cached['stamp'] == stamp:
+                        tables = cached
+                except Exception:
+                    logger.exception(f'ignoring broken {self.cache_path}')
+            if tables is None:
+                tables = self.compile(directory)
+                if self.cache_path:
+                    tables['stamp'] = stamp
+                    os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+                    tmp = self.cache_path + '.tmp'
+                    with open(tmp, 'wb') as f:
+                        pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(tmp, self.cache_path)
+            self.prefixes = tables['prefixes']
+            self.characters = tables['characters']
+            self.phrases = tables['phrases']
+
+    def convert_part(self, text):
+        if text.isascii():
+            return text
+        phrases = self.phrases
+        prefixes = self.prefixes
+        n = len(text)
+        candidates = []
+        for i in range(n):
+            j = i + 1
+            while j <= n:
+                is_phrase = prefixes.get(text[i:j])
+                if is_phrase is None:
+                    break
+                if is_phrase:
+                    candidates.append((i - j, i))
+                j += 1
+        if not candidates:
+            return text.translate(self.characters)
+
+        candidates.sort()
+        taken = bytearray(n)
+        matches = []
+        for negative_length, i in candidates:
+            j = i - negative_length
+            if not any(taken[i:j]):
+                taken[i:j] = b'\x01' * (j - i)
+                matches.append((i, j))
+        matches.sort()
+        parts = []
+        last = 0
+        for i, j in matches:
+            parts.append(text[last:i].translate(self.characters))
+            parts.append(phrases[text[i:j]])
+            last = j
+        parts.append(text[last:].translate(self.characters))
+        return ''.join(parts)
+
+    def convert(self, text):
+        if self.phrases is None:
+            self.load()
+        parts = separators.split(text)
+        # odd items are the separators, which are kept as they are
+        for i in range(0, len(parts), 2):
+            if parts[i]:
+                parts[i] = self.convert_part(parts[i])
+        return ''.join(parts)
+
+    def stream(self):
+        return StreamConverter(self)
+
+    async def convert_stream(self, chunks):
+        """Converts an async stream of text chunks."""
+        stream = self.stream()
+        async for chunk in chunks:
+            text = stream.feed(chunk)
+            if text:
+                yield text
+        text = stream.flush()
+        if text:
+            yield text
+
+
+class StreamConverter:
+    """Converts text that arrives in chunks.
+
+    Text is held back until a separator has been seen, since a phrase
+    never spans one, so the joined output equals converting the whole text
+    at once. A run without separators longer than max_pending is converted
+    anyway to keep the delay bounded.
+    """
+
+    def __init__(self, converter, max_pending=256):
+        self.converter = converter
+        self.max_pending = max_pending
+        self.pending = ''
+
+    def feed(self, chunk):
+        self.pending += chunk
+        end = 0
+        for m in separators.finditer(self.pending):
+            end = m.end()
+        if end == 0 and len(self.pending) > self.max_pending:
+            end = len(self.pending)
+        text, self.pending = self.pending[:end], self.pending[end:]
+        return self.converter.convert(text) if text else ''
+
+    def flush(self):
+        text, self.pending = self.pending, ''
+        return self.converter.convert(text) if text else ''
+
+
+converter = S2TConverter()
@@ -0,0 +1,203 @@
+import os
+import time
+import asyncio
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+from prompt import OLLAMA_KEEP_ALIVE
+from stats import percentile
+from tracing import span
+
+# generations per model at a time, e.g. "gemma3=2,llama3=1"
+OLLAMA_MODEL_CONCURRENCY = os.getenv('OLLAMA_MODEL_CONCURRENCY', '')
+OLLAMA_CONCURRENCY = int(os.getenv('OLLAMA_CONCURRENCY', '2'))
+# models ollama can keep in memory side by side (OLLAMA_MAX_LOADED_MODELS)
+OLLAMA_LOADED_MODELS = int(os.getenv('OLLAMA_LOADED_MODELS', '1'))
+# queue wait after which a user gets the busy reply instead
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv('OLLAMA_QUEUE_TIMEOUT', '20'))
+# wait after which a model that isn't loaded gets its turn
+OLLAMA_SWITCH_AFTER = float(os.getenv('OLLAMA_SWITCH_AFTER', '5'))
+
+
+class Busy(Exception):
+    pass
+
+
+def parse_limits(text):
+    limits = {}
+    for item in text.split(','):
+        if '=' in item:
+            model, limit = item.rsplit('=', 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+
+class ModelScheduler:
+    """Admission control for the shared Ollama host.
+
+    Requests wait in a queue per model. Models that are (as far as we
+    know) loaded are served first, up to their concurrency limit, so
+    requests for the same model are grouped instead of making Ollama swap
+    back and forth. A model that isn't loaded is started once there is
+    room next to the running ones and it wouldn't push out a loaded model
+    that still has queued requests; once it has waited longer than
+    switch_after the loaded models stop taking new requests until it can.
+    The last request before a swap is sent with keep_alive 0 so the model
+    it replaces is unloaded right away.
+    """
+
+    def __init__(self, limits, default_limit, max_loaded, max_wait,
+                 switch_after, window=1000):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.max_loaded = max_loaded
+        self.max_wait = max_wait
+        self.switch_after = switch_after
+        self.window = window
+        self.queues = {}
+        self.running = Counter()
+        self.loaded = OrderedDict()
+        self.loads = 0
+        self.swaps = 0
+        self.models = {}
+
+    def limit(self, model):
+        return self.limits.get(model, self.default_limit)
+
+    def model_stats(self, model):
+        if model not in self.models:
+            self.models[model] = {
+                'granted': 0,
+                'shed': 0,
+                'waits': deque(maxlen=self.window),
+            }
+        return self.models[model]
+
+    @asynccontextmanager
+    async def slot(self, model, shed=True):
+        """Holds one generation slot of model, yields the keep_alive to use.
+        Raises Busy when shed and the wait exceeds max_wait."""
+        with span('ollama_queue', model=model):
+            keep_alive = await self.acquire(model, self.max_wait if shed else None)
+        try:
+            yield keep_alive
+        finally:
+            self.release(model)
+
+    @contextmanager
+    def blocking_slot(self, model, loop):
+        """slot() for code running in a worker thread, loop is the event
+        loop the scheduler runs on. It waits instead of shedding."""
+        future = asyncio.run_coroutine_threadsafe(self.acquire(model, None), loop)
+        try:
+            yield future.result()
+        finally:
+            loop.call_soon_threadsafe(self.release, model)
+
+    async def acquire(self, model, timeout):
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (waiter, time.monotonic())
+        self.queues.setdefault(model, deque()).append(entry)
+        self.pump()
+        try:
+            done, _ = await asyncio.wait([waiter], timeout=timeout)
+        except asyncio.CancelledError:
+            self.abandon(model, entry)
+            raise
+        if not done:
+            self.abandon(model, entry)
+            self.model_stats(model)['shed'] += 1
+            raise Busy(model)
+        return waiter.result()
+
+    def abandon(self, model, entry):
+        waiter = entry[0]
+        if waiter.done() and not waiter.cancelled():
+            # granted in the meantime
+            self.release(model)
+            return
+        waiter.cancel()
+        self.queues[model].remove(entry)
+        self.pump()
+
+    def release(self, model):
+        self.running[model] -= 1
+        self.pump()
+
+    def next_model(self, now):
+        waiting = sorted((queue[0][1], model)
+                         for model, queue in self.queues.items() if queue)
+        starving = any(model not in self.loaded and now - t > self.switch_after
+                       for t, model in waiting)
+        # loading another model would push a busy one out
+        busy_loaded = (len(self.loaded) >= self.max_loaded
+                       and any(model in self.loaded for _, model in waiting))
+        active = {model for model, n in self.running.items() if n > 0}
+        for _, model in waiting:
+            if self.running[model] >= self.limit(model):
+                continue
+            if model in self.loaded:
+                if not starving:
+                    return model
+            elif ((starving or not busy_loaded)
+                  and len(active - {model}) < self.max_loaded):
+                return model
+        return None
+
+    def keep_alive(self, model):
+        others = any(queue for m, queue in self.queues.items()
+                     if m != model and m not in self.loaded)
+        if others and not self.queues[model] and len(self.loaded) >= self.max_loaded:
+            return 0
+        return OLLAMA_KEEP_ALIVE
+
+    def evict(self):
+        # the least recently used model that has nothing running, ollama
+        # can't unload one that is still generating
+        for model in self.loaded:
+            if self.running[model] == 0:
+                del self.loaded[model]
+                self.swaps += 1
+                return
+
+    def pump(self):
+        now = time.monotonic()
+        while True:
+            model = self.next_model(now)
+            if model is None:
+                return
+            waiter, enqueued = self.queues[model].popleft()
+            if model not in self.loaded:
+                self.loads += 1
+                if len(self.loaded) >= self.max_loaded:
+                    self.evict()
+            self.loaded[model] = now
+            self.loaded.move_to_end(model)
+            self.running[model] += 1
+            stats = self.model_stats(model)
+            stats['granted'] += 1
+            stats['waits'].append(now - enqueued)
+            waiter.set_result(self.keep_alive(model))
+
+    def stats(self):
+        models = {}
+        for model, stats in self.models.items():
+            models[model] = {
+                'queued': len(self.queues.get(model, ())),
+                'running': self.running[model],
+                'granted': stats['granted'],
+                'shed': stats['shed'],
+                'wait_p50': percentile(stats['waits'], 0.5),
+                'wait_p95': percentile(stats['waits'], 0.95),
+            }
+        return {
+            'loaded': list(self.loaded),
+            'loads': self.loads,
+            'swaps': self.swaps,
+            'models': models,
+        }
+
+
+scheduler = ModelScheduler(parse_limits(OLLAMA_MODEL_CONCURRENCY), OLLAMA_CONCURRENCY,
+                           OLLAMA_LOADED_MODELS, OLLAMA_QUEUE_TIMEOUT,
+                           OLLAMA_SWITCH_AFTER)
@@ -0,0 +1,89 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+logger = logging.getLogger('uvicorn')
+
+# chat logs are always read per user, newest first
+CHAT_LOG_INDEXES = [
+    IndexModel([('user_id', ASCENDING), ('t', DESCENDING)], name='user_id_t'),
+]
+SUMMARY_INDEXES = [
+    IndexModel([('user_id', ASCENDING)], name='user_id', unique=True),
+]
+
+# served from the user_id_t index alone
+TIME_PROJECTION = {'_id': 0, 't': 1}
+TURN_PROJECTION = {'user_input': 1, 'response': 1, 't': 1}
+
+
+async def ensure_indexes(db, chat_log):
+    try:
+        await chat_log.create_indexes(CHAT_LOG_INDEXES)
+        await db['summaries'].create_indexes(SUMMARY_INDEXES)
+    except Exception:
+        # the bot still works without them, only slower
+        logger.exception(f'failed to create indexes on {chat_log.name}')
+
+
+class RecentTurns:
+    """Per-user ring buffer of the most recent chat log entries.
+
+    A user's buffer is complete once it has been filled from mongo; after
+    that every saved turn is appended, so reads don't need mongo at all.
+    Turns saved before the first read are kept and merged (by _id) into
+    the mongo result, which matters while they are still in the
+    write-behind buffer. Safe to use from worker threads.
+    """
+
+    def __init__(self, size, max_users=10000):
+        self.size = size
+        self.max_users = max_users
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self.lock:
+            item = self.users.get(user_id)
+            if item is None or not item['complete']:
+                self.misses += 1
+                return None
+            self.users.move_to_end(user_id)
+            self.hits += 1
+            return list(item['turns'])
+
+    def fill(self, user_id, entries):
+        with self.lock:
+            item = self.users.get(user_id)
+            pending = list(item['turns']) if item is not None else []
+            ids = {entry['_id'] for entry in entries}
+            turns = deque(entries, maxlen=self.size)
+            turns.extend(entry for entry in pending if entry['_id'] not in ids)
+            self.users[user_id] = {'complete': True, 'turns': turns}
+            self.touch(user_id)
+            return list(turns)
+
+    def append(self, user_id, entry):
+        with self.lock:
+            item = self.users.get(user_id)
+            if item is None:
+                item = {'complete': False, 'turns': deque(maxlen=self.size)}
+                self.users[user_id] = item
+            item['turns'].append(entry)
+            self.touch(user_id)
+
+    def touch(self, user_id):
+        self.users.move_to_end(user_id)
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+
+    def stats(self):
+        return {
+            'users': len(self.users),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,301 @@
+import os
+import re
+import mmap
+import logging
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from bible import bible_codes
+
+logger = logging.getLogger('uvicorn')
+
+BIBLE_TEXT = os.getenv('BIBLE_TEXT', 'bible-zh.txt')
+VERSE_INDEX_PATH = os.getenv('VERSE_INDEX_PATH', 'data/bible/verses.npz')
+MAX_REFERENCE_VERSES = int(os.getenv('MAX_REFERENCE_VERSES', '40'))
+
+codes = list(bible_codes)
+book_numbers = {code: i for i, code in enumerate(codes)}
+
+# names that are cut short in bible_codes, and common variants
+full_names = {
+    'Gen': '創世記',
+    'Lam': '耶利米哀歌',
+    'Oba': '俄巴底亞書',
+    'Zec': '撒迦利亞書',
+    '1Co': '哥林多前書',
+    '2Co': '哥林多後書',
+    '1Ts': '帖撒羅尼迦前書',
+    '2Ts': '帖撒羅尼迦後書',
+    '1Ti': '提摩太前書',
+    '2Ti': '提摩太後書',
+}
+# abbreviations used by the chinese union version
+abbreviations = {
+    'Gen': '創', 'Exo': '出', 'Lev': '利', 'Num': '民', 'Deu': '申',
+    'Jos': '書', 'Jug': '士', 'Rut': '得', '1Sa': '撒上', '2Sa': '撒下',
+    '1Ki': '王上', '2Ki': '王下', '1Ch': '代上', '2Ch': '代下', 'Ezr': '拉',
+    'Neh': '尼', 'Est': '斯', 'Job': '伯', 'Psm': '詩', 'Pro': '箴',
+    'Ecc': '傳', 'Son': '歌', 'Isa': '賽', 'Jer': '耶', 'Lam': '哀',
+    'Eze': '結', 'Dan': '但', 'Hos': '何', 'Joe': '珥', 'Amo': '摩',
+    'Oba': '俄', 'Jon': '拿', 'Mic': '彌', 'Nah': '鴻', 'Hab': '哈',
+    'Zep': '番', 'Hag': '該', 'Zec': '亞', 'Mal': '瑪', 'Mat': '太',
+    'Mak': '可', 'Luk': '路', 'Jhn': '約', 'Act': '徒', 'Rom': '羅',
+    '1Co': '林前', '2Co': '林後', 'Gal': '加', 'Eph': '弗', 'Phl': '腓',
+    'Col': '西', '1Ts': '帖前', '2Ts': '帖後', '1Ti': '提前', '2Ti': '提後',
+    'Tit': '多', 'Phm': '門', 'Heb': '來', 'Jas': '雅', '1Pe': '彼前',
+    '2Pe': '彼後', '1Jn': '約一', '2Jn': '約二', '3Jn': '約三', 'Jud': '猶',
+    'Rev': '啟',
+}
+
+names = {}
+for code, name in bible_codes.items():
+    names[name] = code
+    names[code.lower()] = code
+names.update({name: code for code, name in full_names.items()})
+names.update({'創世紀': 'Gen', '詩篇': 'Psm', '約壹': '1Jn', '約貳': '2Jn',
+              '約參': '3Jn'})
+long_names = dict(names)
+names.update({name: code for code, name in abbreviations.items()})
+
+
+def alternation(names):
+    return '|'.join(re.escape(n) for n in sorted(names, key=len, reverse=True))
+
+
+NUMBER = r'[0-9０-９]+|[〇零一二兩三四五六七八九十百]+'
+DASH = r'[-–—~～－至到]'
+# 哥林多前書 13:4-8, 林前13：4, 約 3:16-4:2, 1co 13:4
+colon_reference = re.compile(
+    rf'({alternation(names)})\s*({NUMBER})\s*[:：]\s*({NUMBER})'
+    rf'(?:\s*{DASH}\s*(?:({NUMBER})\s*[:：]\s*)?({NUMBER}))?', re.IGNORECASE)
+# 哥林多前書十三章四到八節, 詩篇23篇; single character abbreviations are
+# left out, "多3章" is more likely to mean "3 more chapters"
+chapter_reference = re.compile(
+    rf'({alternation(long_names)})\s*第?\s*({NUMBER})\s*[章篇]'
+    rf'(?:\s*第?\s*({NUMBER})(?:\s*{DASH}\s*第?\s*({NUMBER}))?\s*節)?',
+    re.IGNORECASE)
+leftover = re.compile(r'[\s,，、;；.。!！?？和及與]*')
+# a single character abbreviation inside a sentence is usually just a word,
+# "我們約3:30見面"; it counts at the start, after punctuation or one of these
+cues = set('看讀念唸參見查翻背引《〈「『（(')
+
+chinese_digits = {
+    '〇': 0, '零': 0, '一': 1, '二': 2, '兩': 2, '三': 3, '四': 4,
+    '五': 5, '六': 6, '七': 7, '八': 8, '九': 9,
+}
+
+Reference = namedtuple('Reference', ['code', 'chapter', 'verse', 'end_chapter', 'end_verse'])
+
+
+def parse_number(text):
+    if text.isdigit():
+        return int(text)
+    total = 0
+    current = 0
+    for ch in text:
+        if ch == '百':
+            total += (current or 1) * 100
+            current = 0
+        elif ch == '十':
+            total += (current or 1) * 10
+            current = 0
+        else:
+            current = current * 10 + chinese_digits[ch]
+    return total + current
+
+
+def in_context(text, start):
+    if start == 0:
+        return True
+    before = text[start - 1]
+    return before in cues or not '\u4e00' <= before <= '\u9fff'
+
+
+def find_references(text):
+    """Returns (start, end, Reference) for every scripture reference in
+    text. A reference without verses covers the whole chapter
+    (end_verse is None)."""
+    found = []
+    for m in colon_reference.finditer(text):
+        if len(m.group(1)) == 1 and not in_context(text, m.start()):
+            continue
+        code = names[m.group(1).lower()]
+        chapter = parse_number(m.group(2))
+        verse = parse_number(m.group(3))
+        end_chapter = parse_number(m.group(4)) if m.group(4) else chapter
+        end_verse = parse_number(m.group(5)) if m.group(5) else verse
+        found.append((m.start(), m.end(),
+                      Reference(code, chapter, verse, end_chapter, end_verse)))
+    for m in chapter_reference.finditer(text):
+        if any(start <= m.start() < end for start, end, _ in found):
+            continue
+        code = names[m.group(1).lower()]
+        chapter = parse_number(m.group(2))
+        if m.group(3):
+            verse = parse_number(m.group(3))
+            end_verse = parse_number(m.group(4)) if m.group(4) else verse
+        else:
+            verse, end_verse = 1, None
+        found.append((m.start(), m.end(),
+                      Reference(code, chapter, verse, chapter, end_verse)))
+    return sorted(found)
+
+
+def parse_references(text):
+    return [ref for _, _, ref in find_references(text)]
+
+
+def is_reference_only(text):
+    """True when text is nothing but references, e.g. "約翰福音 3:16"."""
+    found = find_references(text)
+    if not found:
+        return False
+    rest = text
+    for start, end, _ in reversed(found):
+        rest = rest[:start] + rest[end:]
+    return leftover.fullmatch(rest) is not None
+
+
+class VerseIndex:
+    """Maps (book, chapter, verse) to the byte range of the verse in the
+    memory-mapped bible text.
+
+    The rows are built from the text once and saved next to a stamp of the
+    source file, so later starts only load a small array. Verses are stored
+    in text order, so a range is a run of consecutive rows.
+    """
+
+    dtype = np.dtype([
+        ('book', 'u1'),
+        ('chapter', 'u2'),
+        ('verse', 'u2'),
+        ('offset', 'u8'),
+        ('length', 'u4'),
+    ])
+
+    def __init__(self, text_path, index_path):
+        self.text_path = text_path
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.rows = None
+        self.text = None
+        self.positions = {}
+        self.chapter_ends = {}
+
+    def stamp(self):
+        st = os.stat(self.text_path)
+        return np.array([st.st_size, st.st_mtime_ns], dtype='i8')
+
+    def build(self):
+        rows = []
+        offset = 0
+        with open(self.text_path, 'rb') as f:
+            for line in f:
+                parts = line.split(b' ', 2)
+                code = parts[0].decode(errors='ignore')
+                if len(parts) == 3 and code in book_numbers and b':' in parts[1]:
+                    chapter, verse = parts[1].split(b':')
+                    start = offset + len(parts[0]) + len(parts[1]) + 2
+                    length = len(parts[2].rstrip(b'\r\n'))
+                    rows.append((book_numbers[code], int(chapter), int(verse),
+                                 start, length))
+                offset += len(line)
+        return np.array(rows, dtype=self.dtype)
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return self.rows is not None
+            self.loaded = True
+            if not os.path.exists(self.text_path):
+                logger.warning(f'{self.text_path} not found, verse lookup disabled')
+                return False
+            stamp = self.stamp()
+            rows = None
+            if os.path.exists(self.index_path):
+                with np.load(self.index_path) as data:
+                    if np.array_equal(data['stamp'], stamp):
+                        rows = data['rows']
+            if rows is None:
+                rows = self.build()
+                os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+                with open(self.index_path, 'wb') as f:
+                    np.savez(f, rows=rows, stamp=stamp)
+                logger.info(f'indexed {len(rows)} verses into {self.index_path}')
+
+            with open(self.text_path, 'rb') as f:
+                self.text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            keys = zip(rows['book'].tolist(), rows['chapter'].tolist(),
+                       rows['verse'].tolist())
+            for i, key in enumerate(keys):
+                self.positions[key] = i
+                self.chapter_ends[key[:2]] = i
+            self.rows = rows
+            return True
+
+    def lookup(self, ref, limit=MAX_REFERENCE_VERSES):
+        """Returns [(chapter, verse, text)] for the reference, at most limit
+        verses, or [] if it doesn't exist."""
+        if not self.load():
+            return []
+        book = book_numbers[ref.code]
+        first = self.positions.get((book, ref.chapter, ref.verse))
+        if first is None:
+            return []
+        last = None
+        if ref.end_verse is not None:
+            last = self.positions.get((book, ref.end_chapter, ref.end_verse))
+        if last is None:
+            last = self.chapter_ends.get((book, ref.end_chapter),
+                                         self.chapter_ends[(book, ref.chapter)])
+        last = min(last, first + limit - 1)
+        return [self.verse_at(i)[1:] for i in range(first, last + 1)]
+
+    def position(self, code, chapter, verse):
+        if not self.load():
+            return None
+        return self.positions.get((book_numbers[code], chapter, verse))
+
+    def verse_at(self, i):
+        """Returns (code, chapter, verse, text) of the i-th verse."""
+        row = self.rows[i]
+        offset = int(row['offset'])
+        text = self.text[offset:offset + int(row['length'])].decode()
+        return codes[row['book']], int(row['chapter']), int(row['verse']), text
+
+    def __len__(self):
+        return len(self.rows) if self.load() else 0
+
+
+verse_index = VerseIndex(BIBLE_TEXT, VERSE_INDEX_PATH)
+
+
+def book_title(code):
+    return full_names.get(code, bible_codes[code])
+
+
+def format_passage(ref, verses):
+    first, last = verses[0], verses[-1]
+    title = f'{book_title(ref.code)} {first[0]}:{first[1]}'
+    if last[:2] != first[:2]:
+        title += f'-{last[0]}:{last[1]}' if last[0] != first[0] else f'-{last[1]}'
+    lines = [title]
+    for chapter, verse, text in verses:
+        if last[0] != first[0]:
+            lines.append(f'{chapter}:{verse} {text}')
+        else:
+            lines.append(f'{verse} {text}')
+    return '\n'.join(lines)
+
+
+def find_passages(text, index=verse_index):
+    """Looks up every reference in text and returns the formatted passages."""
+    passages = []
+    for ref in parse_references(text):
+        verses = index.lookup(ref)
+        if verses:
+            passages.append(format_passage(ref, verses))
+    return passages
@@ -0,0 +1,6 @@
+def percentile(values, p):
+    """The p-quantile (0 to 1) of values, nearest rank, 0.0 when empty."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p * len(values)))]
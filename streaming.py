@@ -0,0 +1,163 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+from linebot.v3.messaging import ReplyMessageRequest, PushMessageRequest, TextMessage
+
+from stats import percentile
+
+logger = logging.getLogger('uvicorn')
+
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '0') == '1'
+# deadline: reply with whole sentences once STREAM_REPLY_DEADLINE has passed
+# sentence: reply as soon as the first sentence is complete
+STREAM_REPLY_AT = os.getenv('STREAM_REPLY_AT', 'deadline')
+STREAM_REPLY_DEADLINE = float(os.getenv('STREAM_REPLY_DEADLINE', '3.0'))
+
+# LINE messaging API limits
+MAX_TEXT_LENGTH = 5000
+MAX_MESSAGES = 5
+
+SENTENCE_ENDINGS = '。！？；!?;\n'
+
+
+class StreamStats:
+
+    def __init__(self, window=1000):
+        self.replies = 0
+        self.pushes = 0
+        self.first_message = deque(maxlen=window)
+        self.total = deque(maxlen=window)
+
+    def record(self, first_message, total, pushed):
+        self.replies += 1
+        self.pushes += pushed
+        self.first_message.append(first_message)
+        self.total.append(total)
+
+    def stats(self):
+        return {
+            'replies': self.replies,
+            'pushes': self.pushes,
+            'first_message_p50': percentile(self.first_message, 0.5),
+            'first_message_p95': percentile(self.first_message, 0.95),
+            'total_p50': percentile(self.total, 0.5),
+            'total_p95': percentile(self.total, 0.95),
+        }
+
+
+stream_stats = StreamStats()
+
+
+def last_sentence_end(text):
+    for i in range(len(text) - 1, -1, -1):
+        if text[i] in SENTENCE_ENDINGS or (text[i] == '.' and i + 1 < len(text)
+                                           and text[i + 1] == ' '):
+            return i + 1
+    return 0
+
+
+def split_message(text, limit=MAX_TEXT_LENGTH):
+    messages = []
+    while len(text) > limit:
+        cut = last_sentence_end(text[:limit]) or limit
+        messages.append(text[:cut])
+        text = text[cut:]
+    if text.strip():
+        messages.append(text)
+    return messages
+
+
+def to_messages(text, convert):
+    parts = split_message(convert(text.strip()))
+    if len(parts) > MAX_MESSAGES:
+        parts = parts[:MAX_MESSAGES]
+        parts[-1] = parts[-1][:MAX_TEXT_LENGTH - 1] + '…'
+    return [TextMessage(text=part) for part in parts]
+
+
+async def stream_reply(chunks, line_api, reply_token, to, convert=lambda t: t,
+                       error_reply='Sorry, something went wrong. Please ask me again.'):
+    """Reply with the first part of a streamed answer, push the rest.
+
+    The reply goes out once the deadline has passed (or the first sentence
+    is complete, depending on STREAM_REPLY_AT) and is cut at a sentence
+    boundary. If the stream finishes first, it is a single plain reply.
+
+    Errors before the reply are raised, the event can still be redelivered.
+    Once the reply is out they are logged and error_reply is pushed
+    instead, a redelivery would answer the user twice.
+    """
+    start = time.monotonic()
+    queue = asyncio.Queue()
+
+    async def consume():
+        try:
+            async for chunk in chunks:
+                queue.put_nowait(chunk)
+        finally:
+            queue.put_nowait(None)
+
+    consumer = asyncio.create_task(consume())
+    text = ''
+    replied = False
+    first_message = None
+    done = False
+    failed = False
+    try:
+        while not done:
+            timeout = None
+            remaining = start + STREAM_REPLY_DEADLINE - time.monotonic()
+            if not replied and STREAM_REPLY_AT == 'deadline' and remaining > 0:
+                timeout = remaining
+            try:
+                chunk = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                chunk = ''
+            if chunk is None:
+                done = True
+            else:
+                text += chunk
+            if replied or done:
+                continue
+
+            cut = last_sentence_end(text)
+            deadline_passed = time.monotonic() - start >= STREAM_REPLY_DEADLINE
+            if cut and (STREAM_REPLY_AT == 'sentence' or deadline_passed):
+                messages = to_messages(text[:cut], convert)
+                if messages:
+                    request = ReplyMessageRequest(reply_token=reply_token,
+                                                  messages=messages)
+                    await line_api.reply_message(request)
+                    first_message = time.monotonic() - start
+                    replied = True
+                    text = text[cut:]
+        await consumer
+    except Exception:
+        if not replied:
+            raise
+        logger.exception(f'stream to {to} failed after the reply')
+        failed = True
+    finally:
+        consumer.cancel()
+
+    pushed = 0
+    messages = to_messages(text, convert)
+    if not replied:
+        request = ReplyMessageRequest(reply_token=reply_token,
+                                      messages=messages or [TextMessage(text='…')])
+        await line_api.reply_message(request)
+        first_message = time.monotonic() - start
+    else:
+        if failed:
+            messages = messages[:MAX_MESSAGES - 1] + [TextMessage(text=error_reply)]
+        if messages:
+            try:
+                await line_api.push_message(PushMessageRequest(to=to, messages=messages))
+                pushed = 1
+            except Exception:
+                logger.exception(f'push to {to} failed after the reply')
+
+    stream_stats.record(first_message, time.monotonic() - start, pushed)
@@ -0,0 +1,39 @@
+from agent import parse
+
+
+def test_parse_final_answer():
+    actions, answer = parse('Thought: I know this.\nFinal Answer: It is 42.\n')
+    assert actions == []
+    assert answer == 'It is 42.'
+
+
+def test_parse_nothing():
+    assert parse('Thought: let me think') == ([], None)
+
+
+def test_parse_action():
+    text = 'Thought: multiply\nAction: calculator_tool\nAction Input: "3102 * 48102"'
+    actions, answer = parse(text)
+    assert answer is None
+    assert [(a.tool, a.tool_input) for a in actions] == [('calculator_tool', '3102 * 48102')]
+    assert actions[0].log == text
+
+
+def test_parse_several_actions():
+    text = ('Thought: both\n'
+            'Action 1: calculator_tool\nAction 1 Input: 1 + 1\n'
+            'Action 2: current_time_tool\nAction 2 Input: now\n')
+    actions, answer = parse(text)
+    assert answer is None
+    assert [(a.tool, a.tool_input) for a in actions] == [
+        ('calculator_tool', '1 + 1'), ('current_time_tool', 'now')]
+    # each log holds the text since the previous action
+    assert actions[0].log.startswith('Thought: both')
+    assert actions[1].log.startswith('\nAction 2: current_time_tool')
+
+
+def test_parse_actions_win_over_final_answer():
+    text = 'Action: calculator_tool\nAction Input: 2 * 2\nFinal Answer: 4'
+    actions, answer = parse(text)
+    assert answer is None
+    assert [a.tool for a in actions] == ['calculator_tool']
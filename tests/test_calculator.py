@@ -0,0 +1,54 @@
+import pytest
+
+from calculator import MAX_LENGTH, evaluate
+
+
+@pytest.mark.parametrize('expression, value', [
+    ('3102 * 48102', 149212404),
+    ('(2 + 3) ** 2 / 4', 6.25),
+    ('-7 // 2 % 5', 1),
+    ('+1.5 - -2', 3.5),
+    ('2 ** -2', 0.25),
+    ('`1 + 1`', 2),
+    ('10 ** 100', 10 ** 100),
+])
+def test_arithmetic(expression, value):
+    assert evaluate(expression) == value
+
+
+@pytest.mark.parametrize('expression', [
+    '9 ** 9 ** 9',
+    '2 ** 101',
+    '(10 ** 100) ** 100',
+    ' * '.join(['10 ** 100'] * 11),
+    '(-8) ** 0.5',
+    '1e308 * 10',
+    '1e400',
+    '-1e308 * 10',
+    '1' * (MAX_LENGTH + 1),
+])
+def test_bounds(expression):
+    with pytest.raises(ValueError):
+        evaluate(expression)
+
+
+@pytest.mark.parametrize('expression', [
+    '__import__("os").system("true")',
+    'open("/etc/passwd")',
+    'x + 1',
+    '(1).real',
+    '[1, 2]',
+    '"a" * 3',
+    'True + 1',
+    '1j',
+    'lambda: 1',
+    '1 +',
+])
+def test_rejects_anything_else(expression):
+    with pytest.raises(ValueError):
+        evaluate(expression)
+
+
+def test_division_by_zero():
+    with pytest.raises(ZeroDivisionError):
+        evaluate('1 / 0')
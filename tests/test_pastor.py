@@ -0,0 +1,48 @@
+import os
+import importlib
+
+import pytest
+
+pytest.importorskip('fastapi')
+pytest.importorskip('ollama')
+
+CONFIG = """[pastor]
+LINE_CHANNEL_SECRET = test
+LINE_CHANNEL_ACCESS_TOKEN = test
+
+[mongo]
+username = test
+password = test
+"""
+
+
+@pytest.fixture(scope='module')
+def pastor(tmp_path_factory):
+    # pastor reads config.ini from the working directory at import
+    directory = tmp_path_factory.mktemp('pastor')
+    (directory / 'config.ini').write_text(CONFIG)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        return importlib.import_module('pastor')
+    finally:
+        os.chdir(cwd)
+
+
+def turn(n):
+    return {'user_input': f'question {n}', 'response': f'answer {n}'}
+
+
+def test_create_messages_replays_earlier_turns(pastor):
+    # query_turns returns the newest turn first
+    turns = [turn(2), turn(1)]
+    messages, _ = pastor.create_messages(turns, 'Tester', 'question 3')
+    contents = [m['content'] for m in messages[1:]]
+    assert contents[:4] == ['question 1', 'answer 1', 'question 2', 'answer 2']
+    assert contents[-1].startswith('question 3')
+
+
+def test_create_messages_drops_turns_over_budget(pastor, monkeypatch):
+    monkeypatch.setattr(pastor.pastor_context, 'budget', 0)
+    messages, _ = pastor.create_messages([turn(1)], 'Tester', 'question 2')
+    assert [m['role'] for m in messages] == ['system', 'user']
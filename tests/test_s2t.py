@@ -0,0 +1,114 @@
+import random
+import asyncio
+
+import pytest
+
+opencc = pytest.importorskip('opencc')
+
+from s2t import S2TConverter, dictionary_dir, read_dictionary
+
+TEXTS = [
+    '',
+    'hello, world',
+    '你好！我是耀西，今天想聊些什么呢？',
+    '发展经济的同时也要注意环境保护，这样才能实现可持续发展。',
+    '干杯！祝你生日快乐，万事如意，心想事成。',
+    '在这个系统里面，后台程序会定时把数据写回数据库，然后发送通知给用户。',
+    '他说："我们下周一起去公园里面划船吧。" 我回答：好啊，不见不散！',
+    '面对困难的时候，不要轻易放弃 — 坚持下去，总会看见彩虹。',
+    '头发\n发展\n理发店里面',
+]
+SEPARATORS = ['，', '。', ' ', '\n', '-', '？', '！', '：', 'a', 'ok', '1']
+
+
+@pytest.fixture(scope='module')
+def reference():
+    return opencc.OpenCC('s2t')
+
+
+@pytest.fixture(scope='module')
+def converter():
+    return S2TConverter(cache_path=None)
+
+
+@pytest.fixture(scope='module')
+def dictionaries():
+    directory = dictionary_dir()
+    phrases = list(read_dictionary(f'{directory}/STPhrases.txt'))
+    characters = list(read_dictionary(f'{directory}/STCharacters.txt'))
+    return phrases, characters
+
+
+def random_text(rng, phrases, characters):
+    # whole phrases, phrase tails that can overlap the next phrase,
+    # single characters and separators
+    parts = []
+    for _ in range(rng.randint(1, 16)):
+        r = rng.random()
+        if r < 0.4:
+            phrase = rng.choice(phrases)
+            if rng.random() < 0.3:
+                phrase = phrase[rng.randint(1, len(phrase) - 1):]
+            parts.append(phrase)
+        elif r < 0.8:
+            parts.append(rng.choice(characters))
+        else:
+            parts.append(rng.choice(SEPARATORS))
+    return ''.join(parts)
+
+
+def convert_chunks(converter, chunks):
+    stream = converter.stream()
+    output = [stream.feed(chunk) for chunk in chunks]
+    output.append(stream.flush())
+    return ''.join(output)
+
+
+@pytest.mark.parametrize('text', TEXTS)
+def test_fixed_texts(reference, converter, text):
+    assert converter.convert(text) == reference.convert(text)
+
+
+def test_random_texts(reference, converter, dictionaries):
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = random_text(rng, *dictionaries)
+        assert converter.convert(text) == reference.convert(text), text
+
+
+def test_random_chunks(reference, converter, dictionaries):
+    rng = random.Random(1)
+    for _ in range(500):
+        text = random_text(rng, *dictionaries)
+        chunks = []
+        i = 0
+        while i < len(text):
+            n = rng.randint(1, 8)
+            chunks.append(text[i:i + n])
+            i += n
+        assert convert_chunks(converter, chunks) == reference.convert(text), text
+
+
+def test_chunk_boundary_inside_phrase(reference, converter, dictionaries):
+    rng = random.Random(2)
+    phrases = [p for p in dictionaries[0] if len(p) >= 3]
+    for phrase in rng.sample(phrases, 200):
+        text = f'我说{phrase}了，{phrase}'
+        expected = reference.convert(text)
+        start = text.index(phrase)
+        for cut in range(start + 1, start + len(phrase)):
+            chunks = [text[:cut], text[cut:]]
+            assert convert_chunks(converter, chunks) == expected, (text, cut)
+
+
+def test_convert_stream(reference, converter):
+    text = TEXTS[3]
+
+    async def chunks():
+        for ch in text:
+            yield ch
+
+    async def collect():
+        return ''.join([part async for part in converter.convert_stream(chunks())])
+
+    assert asyncio.run(collect()) == reference.convert(text)
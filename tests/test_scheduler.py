@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from scheduler import Busy, ModelScheduler
+
+
+def create_scheduler(max_loaded=1, max_wait=5, switch_after=60):
+    return ModelScheduler({}, 1, max_loaded, max_wait, switch_after)
+
+
+async def run(scheduler, models):
+    order = []
+
+    async def generate(model):
+        async with scheduler.slot(model):
+            order.append(model)
+            await asyncio.sleep(0.01)
+
+    tasks = []
+    for model in models:
+        tasks.append(asyncio.create_task(generate(model)))
+        # queue them in this order
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_groups_requests_by_model():
+    scheduler = create_scheduler()
+    assert asyncio.run(run(scheduler, 'abab')) == list('aabb')
+    assert scheduler.loads == 2
+    assert scheduler.swaps == 1
+
+
+def test_switches_to_a_starving_model():
+    scheduler = create_scheduler(switch_after=0)
+    assert asyncio.run(run(scheduler, 'abab')) == list('abab')
+
+
+def test_busy_after_the_admission_timeout():
+    scheduler = create_scheduler(max_wait=0.05)
+
+    async def main():
+        async with scheduler.slot('a'):
+            with pytest.raises(Busy):
+                async with scheduler.slot('a'):
+                    pass
+        # the shed request left the queue, the next one is granted at once
+        async with scheduler.slot('a'):
+            pass
+
+    asyncio.run(main())
+    assert scheduler.stats()['models']['a']['shed'] == 1
+    assert scheduler.running['a'] == 0
+
+
+def test_evicts_an_idle_model():
+    scheduler = create_scheduler(max_loaded=2)
+
+    async def main():
+        async with scheduler.slot('a'):
+            async with scheduler.slot('b'):
+                pass
+            # a is the least recently used but still running, b goes
+            async with scheduler.slot('c'):
+                assert list(scheduler.loaded) == ['a', 'c']
+
+    asyncio.run(main())
+    assert scheduler.swaps == 1
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+import streaming
+from streaming import stream_reply
+
+
+class FakeLineApi:
+
+    def __init__(self):
+        self.replies = []
+        self.pushes = []
+
+    async def reply_message(self, request):
+        self.replies.append([m.text for m in request.messages])
+
+    async def push_message(self, request):
+        self.pushes.append([m.text for m in request.messages])
+
+
+async def chunks(parts, error=None):
+    for part in parts:
+        yield part
+        await asyncio.sleep(0)
+    if error:
+        raise error
+
+
+@pytest.fixture(autouse=True)
+def reply_at_first_sentence(monkeypatch):
+    monkeypatch.setattr(streaming, 'STREAM_REPLY_AT', 'sentence')
+
+
+def test_replies_then_pushes_the_rest():
+    api = FakeLineApi()
+    asyncio.run(stream_reply(chunks(['Hello. ', 'How are ', 'you?']), api, 'token', 'U1'))
+    assert api.replies == [['Hello.']]
+    assert api.pushes == [['How are you?']]
+
+
+def test_error_before_the_reply_is_raised():
+    api = FakeLineApi()
+    with pytest.raises(RuntimeError):
+        asyncio.run(stream_reply(chunks(['Hel'], RuntimeError('lost')), api, 'token', 'U1'))
+    assert api.replies == []
+    assert api.pushes == []
+
+
+def test_error_after_the_reply_pushes_the_apology():
+    api = FakeLineApi()
+    asyncio.run(stream_reply(chunks(['Hello. ', 'How'], RuntimeError('lost')), api,
+                             'token', 'U1', error_reply='Sorry.'))
+    assert api.replies == [['Hello.']]
+    assert api.pushes == [['How', 'Sorry.']]
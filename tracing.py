@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger('uvicorn')
+
+# fraction of turns whose spans are logged and kept for /traces
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+TRACE_KEEP = int(os.getenv('TRACE_KEEP', '100'))
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {total}')
+        return lines
+
+
+class Metrics:
+    """Histograms and counters by name and labels, in Prometheus text format.
+
+    Spans end on the event loop and in worker threads, so updates take a
+    lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.help = {}
+
+    def observe(self, name, labels, value, buckets=SECONDS_BUCKETS):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        described = set()
+
+        def header(name):
+            if name in described or name not in self.help:
+                return
+            described.add(name)
+            kind, text = self.help[name]
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), histogram in histograms:
+            header(name)
+            lines.extend(histogram.render(name, format_labels(labels)))
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{{{format_labels(labels)}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    return ','.join(f'{key}="{value}"' for key, value in labels)
+
+
+metrics = Metrics()
+metrics.describe('linebots_stage_seconds', 'histogram', 'Time spent in one stage of a turn.')
+metrics.describe('linebots_turn_seconds', 'histogram', 'Time from handling a message to its reply.')
+metrics.describe('linebots_prompt_tokens_total', 'counter', 'Prompt tokens Ollama evaluated.')
+metrics.describe('linebots_completion_tokens_total', 'counter', 'Tokens Ollama generated.')
+metrics.describe('linebots_tokens_per_second', 'histogram', 'Ollama generation speed.')
+metrics.describe('linebots_log_dropped_total', 'counter', 'Log records dropped while the log writer was behind.')
+traces = deque(maxlen=TRACE_KEEP)
+
+
+class Trace:
+
+    def __init__(self, bot, sampled):
+        self.id = uuid.uuid4().hex
+        self.bot = bot
+        self.sampled = sampled
+        self.start = time.monotonic()
+        self.spans = []
+
+
+@contextmanager
+def trace(bot):
+    """One turn of bot; spans inside it are labelled with the bot."""
+    t = Trace(bot, random.random() < TRACE_SAMPLE_RATE)
+    token = current_trace.set(t)
+    try:
+        yield t
+    finally:
+        current_trace.reset(token)
+        duration = time.monotonic() - t.start
+        metrics.observe('linebots_turn_seconds', (('bot', bot),), duration)
+        if t.sampled:
+            record = {'trace': t.id, 'bot': bot, 'duration': duration,
+                      'spans': t.spans}
+            traces.append(record)
+            logger.info(json.dumps(record, ensure_ascii=False))
+
+
+@contextmanager
+def span(stage, **attributes):
+    """Times stage of the current turn; works in async code and threads."""
+    t = current_trace.get()
+    start = time.monotonic()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.monotonic() - start
+        bot = t.bot if t is not None else 'none'
+        metrics.observe('linebots_stage_seconds', (('bot', bot), ('stage', stage)), duration)
+        if t is not None and t.sampled:
+            record = {'stage': stage, 'offset': start - t.start, 'duration': duration}
+            record.update(attributes)
+            if error:
+                record['error'] = error
+            t.spans.append(record)
+
+
+def record_generation(bot, response):
+    """Token counts and speed from a finished Ollama response."""
+    labels = (('bot', bot),)
+    prompt_tokens = response.get('prompt_eval_count') or 0
+    tokens = response.get('eval_count') or 0
+    duration = response.get('eval_duration') or 0
+    metrics.inc('linebots_prompt_tokens_total', labels, prompt_tokens)
+    metrics.inc('linebots_completion_tokens_total', labels, tokens)
+    if tokens and duration:
+        metrics.observe('linebots_tokens_per_second', labels, tokens / (duration / 1e9),
+                        TOKENS_PER_SECOND_BUCKETS)
+    t = current_trace.get()
+    if t is not None and t.sampled:
+        t.spans.append({'stage': 'tokens', 'prompt_tokens': prompt_tokens,
+                        'completion_tokens': tokens})
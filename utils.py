@@ -1,93 +1,442 @@
 import os
+import asyncio
 import requests
 import json
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import logging
 import uuid
+import time
+from collections import OrderedDict
 
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import MongoClient, AsyncMongoClient
+import httpx
 import ollama
-from sentence_transformers import SentenceTransformer
+from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, Configuration
+
+from embedding import EmbeddingService
+from write_behind import insert_entries
+from prompt import OLLAMA_KEEP_ALIVE, prompt_stats
+from scheduler import scheduler
+from tracing import span
+from logs import log_turn
 
 logger = logging.getLogger('uvicorn')
-embedder = SentenceTransformer("all-MiniLM-L6-v2", device='cpu')
+embedding_service = EmbeddingService(
+    "all-MiniLM-L6-v2",
+    backend=os.getenv('EMBEDDING_BACKEND', 'torch'),
+    max_batch_size=int(os.getenv('EMBEDDING_BATCH_SIZE', '32')),
+    max_wait=float(os.getenv('EMBEDDING_MAX_WAIT_MS', '5')) / 1000,
+    cache_dir=os.getenv('EMBEDDING_CACHE_DIR', 'data/embeddings'),
+    cache_size=int(os.getenv('EMBEDDING_CACHE_SIZE', '10000')),
+)
 ollama_client = ollama.Client()
+async_ollama_client = ollama.AsyncClient()
+http_client = httpx.AsyncClient(
+    timeout=float(os.getenv('LINE_HTTP_TIMEOUT', '5.0')),
+    limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=120),
+)
+http_session = requests.Session()
+async_chroma_client = None
+# the bench points this at its fake LINE server
+LINE_API_HOST = os.getenv('LINE_API_HOST', 'https://api.line.me')
 
 
-def get_mongo_client():
+def create_line_api():
+    configuration = Configuration(host=LINE_API_HOST)
+    configuration.connection_pool_maxsize = int(os.getenv('LINE_POOL_SIZE', '32'))
+    return AsyncMessagingApi(AsyncApiClient(configuration))
+
+
+# one connection pool for the messaging API of every channel
+line_api = create_line_api()
+
+
+class ChannelApi:
+    """The shared LINE messaging client, authenticated as one channel."""
+
+    def __init__(self, channel_access_token):
+        self.auth = {
+            'type': 'bearer',
+            'in': 'header',
+            'key': 'Authorization',
+            'value': f'Bearer {channel_access_token}',
+        }
+
+    async def reply_message(self, request):
+        return await line_api.reply_message(request, _request_auth=self.auth)
+
+    async def push_message(self, request):
+        return await line_api.push_message(request, _request_auth=self.auth)
+
+
+def get_mongo_url():
     mongo_host = os.getenv('MONGO_HOST')
     mongo_username = os.getenv('MONGO_USERNAME')
     mongo_password = os.getenv('MONGO_PASSWORD')
-    mongo_url = f'mongodb://{mongo_username}:{mongo_password}@{mongo_host}/'
-    return MongoClient(mongo_url)
+    return f'mongodb://{mongo_username}:{mongo_password}@{mongo_host}/'
+
+
+def get_mongo_client():
+    return MongoClient(get_mongo_url())
+
+
+def get_async_mongo_client():
+    return AsyncMongoClient(get_mongo_url())
+
+
+async def get_async_chroma_client():
+    global async_chroma_client
+    if async_chroma_client is None:
+        import chromadb
+        async_chroma_client = await chromadb.AsyncHttpClient(
+            host=os.getenv('CHROMA_HOST'), port=int(os.getenv('CHROMA_PORT')))
+    return async_chroma_client
+
+
+def create_async_chroma_getter(name):
+    collection = None
+
+    async def get_collection():
+        nonlocal collection
+        if collection is None:
+            client = await get_async_chroma_client()
+            collection = await client.get_or_create_collection(name)
+        return collection
+
+    return get_collection
+
+
+class ProfileCache:
+    """LRU + TTL cache for LINE profiles keyed by (channel, user_id).
+
+    Concurrent misses for the same key share one fetch, and failed fetches
+    are cached for a shorter time with a fallback profile.
+    """
+
+    def __init__(self, max_size, ttl, negative_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.errors = 0
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, profile = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return profile
+
+    def put(self, key, profile, ttl):
+        self.entries[key] = (time.monotonic() + ttl, profile)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get(self, key, fetch, fallback):
+        profile = self.lookup(key)
+        if profile is not None:
+            self.hits += 1
+            return profile
+
+        task = self.inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self.load(key, fetch, fallback))
+            self.inflight[key] = task
+        else:
+            self.collapsed += 1
+        return await asyncio.shield(task)
+
+    async def load(self, key, fetch, fallback):
+        try:
+            profile = await fetch()
+            self.put(key, profile, self.ttl)
+        except Exception:
+            self.errors += 1
+            logger.exception(f'failed to fetch profile for {key[1]}')
+            profile = fallback
+            self.put(key, profile, self.negative_ttl)
+        finally:
+            del self.inflight[key]
+        return profile
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.collapsed
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'collapsed': self.collapsed,
+            'errors': self.errors,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+profile_cache = ProfileCache(
+    max_size=int(os.getenv('PROFILE_CACHE_SIZE', '4096')),
+    ttl=float(os.getenv('PROFILE_CACHE_TTL', '3600')),
+    negative_ttl=float(os.getenv('PROFILE_CACHE_NEGATIVE_TTL', '60')),
+)
 
 
 def get_user_profile(user_id, channel_access_token):
-    url = f'https://api.line.me/v2/bot/profile/{user_id}'
+    url = f'{LINE_API_HOST}/v2/bot/profile/{user_id}'
     headers = {'Authorization': f'Bearer {channel_access_token}'}
-    r = requests.get(url, headers=headers)
+    r = http_session.get(url, headers=headers)
     return json.loads(r.content)
 
 
+async def get_user_profile_async(user_id, channel_access_token,
+                                 fallback_name='friend'):
+
+    async def fetch():
+        url = f'{LINE_API_HOST}/v2/bot/profile/{user_id}'
+        headers = {'Authorization': f'Bearer {channel_access_token}'}
+        r = await http_client.get(url, headers=headers)
+        r.raise_for_status()
+        return r.json()
+
+    fallback = {'userId': user_id, 'displayName': fallback_name}
+    key = (channel_access_token, user_id)
+    return await profile_cache.get(key, fetch, fallback)
+
+
+def encode(texts, cache=True):
+    return embedding_service.encode(texts, cache=cache)
+
+
+async def encode_async(texts, cache=True):
+    # batched and encoded off the event loop by the embedding service
+    return await embedding_service.encode_async(texts, cache=cache)
+
+
+def chat_history_items(results):
+    documents = results['documents'][0]
+    metadatas = results['metadatas'][0]
+    result = []
+    for i, doc in enumerate(documents):
+        metadata = metadatas[i]
+        t = metadata['time']
+        result.append(f'{doc}\n\t\t-- {t}')
+    return result
+
+
+def format_chat_history(items):
+    if len(items) == 0:
+        return None
+    return '\n\n'.join(items)
+
+
+def create_chat_entry(model, user_id, user_input, reply):
+    return {
+        '_id': ObjectId(),
+        'model': model,
+        'user_id': user_id,
+        'user_input': user_input,
+        'response': reply,
+        't': datetime.now(ZoneInfo("Asia/Taipei")),
+    }
+
+
 def create_chat_function(create_system_prompt, chroma, mongo, model, name,
                          history_prompt):
 
     def query_chat_history(user_input, user_id, n_results=10):
-        results = chroma.query(
-            query_texts=[user_input],
-            n_results=n_results,
-            where={'user_id': user_id},
-        )
-        documents = results['documents'][0]
-        metadatas = results['metadatas'][0]
-        result = []
-        for i, doc in enumerate(documents):
-            metadata = metadatas[i]
-            t = metadata['time']
-            result.append(f'{doc}\n\t\t-- {t}')
-        if len(result) == 0:
-            return None
-        return '\n\n'.join(result)
+        with span('embed'):
+            query_embeddings = encode([user_input])
+        with span('chroma_query'):
+            results = chroma.query(
+                query_embeddings=query_embeddings.tolist(),
+                n_results=n_results,
+                where={'user_id': user_id},
+            )
+        return format_chat_history(chat_history_items(results))
 
     def chat(user_input, user_name, user_id):
         messages = []
-        system = create_system_prompt(user_name)
         chat_history = query_chat_history(user_input, user_id)
-        if chat_history:
-            system += '\n\n' + history_prompt + '\n' + chat_history
-        logger.info(system)
+        with span('prompt_build'):
+            system = create_system_prompt(user_name)
+            if chat_history:
+                system += '\n\n' + history_prompt + '\n' + chat_history
         messages.append({'role': 'system', 'content': system})
         messages.append({'role': 'user', 'content': user_input})
 
-        response = ollama_client.chat(model=model, messages=messages)
+        with span('generate', model=model):
+            response = ollama_client.chat(model=model, messages=messages,
+                                          keep_alive=OLLAMA_KEEP_ALIVE)
+        prompt_stats.record(name, response)
         reply = response['message']['content']
-        logger.info(messages[-1])
-        logger.info(reply)
+        log_turn(logger, name, system=system, user=user_input, reply=reply)
 
         t = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
         text = f'{user_name}: {user_input}\n{name}: {reply}'
         texts = [text]
         ids = [str(uuid.uuid4()) for _ in texts]
 
-        embeddings = embedder.encode(texts).tolist()
-        chroma.add(
-            embeddings=embeddings,
-            documents=texts,
-            metadatas=[{
-                'user_id': user_id,
-                'time': t,
-            }],
-            ids=ids,
+        # each turn is unique, so it isn't worth a cache entry
+        with span('embed'):
+            embeddings = encode(texts, cache=False)
+        with span('chroma_add'):
+            chroma.add(
+                embeddings=embeddings.tolist(),
+                documents=texts,
+                metadatas=[{
+                    'user_id': user_id,
+                    'time': t,
+                }],
+                ids=ids,
+            )
+        with span('mongo_insert'):
+            mongo.insert_many([create_chat_entry(model, user_id, user_input, reply)])
+        return reply
+
+    return chat
+
+
+def create_async_chat_function(prompt, get_chroma, mongo, model, name,
+                               memory=None, writer=None, context=None,
+                               summary=None):
+
+    async def flush_chroma(records):
+        chroma = await get_chroma()
+        await chroma.upsert(
+            ids=[r['id'] for r in records],
+            embeddings=[r['embedding'] for r in records],
+            documents=[r['document'] for r in records],
+            metadatas=[r['metadata'] for r in records],
         )
-        entry = {
-            'model': model,
+
+    async def flush_mongo(entries):
+        await insert_entries(mongo, entries)
+
+    if writer is not None:
+        writer.register(f'{name}:chroma', flush_chroma)
+        writer.register(f'{name}:mongo', flush_mongo)
+
+    async def save(chroma, ids, embeddings, texts, metadatas, entry):
+        if writer is None:
+            await chroma.add(
+                embeddings=embeddings.tolist(),
+                documents=texts,
+                metadatas=metadatas,
+                ids=ids,
+            )
+            await insert_entries(mongo, [entry])
+            return
+        for i, id in enumerate(ids):
+            writer.put(f'{name}:chroma', {
+                'id': id,
+                'embedding': embeddings[i].tolist(),
+                'document': texts[i],
+                'metadata': metadatas[i],
+            })
+        writer.put(f'{name}:mongo', entry)
+
+    async def query_chat_history(chroma, user_input, user_id, n_results=10):
+        with span('embed'):
+            query_embeddings = await encode_async([user_input])
+        if memory is not None:
+            with span('memory_query'):
+                results = await memory.query(chroma, user_id, query_embeddings[0],
+                                             n_results)
+            return chat_history_items(results)
+        with span('chroma_query'):
+            results = await chroma.query(
+                query_embeddings=query_embeddings.tolist(),
+                n_results=n_results,
+                where={'user_id': user_id},
+            )
+        return chat_history_items(results)
+
+    async def create_messages(chroma, user_input, user_name, user_id):
+        messages = []
+        items = await query_chat_history(chroma, user_input, user_id)
+        user_summary = None
+        if summary is not None:
+            with span('summary'):
+                user_summary = await summary.get(user_id)
+        with span('prompt_build'):
+            if context is not None:
+                budget = context.start([prompt.build(user_name), user_input])
+                if user_summary and not budget.take(user_summary):
+                    user_summary = None
+                items = [item for item in items if budget.take(item)]
+            system = prompt.build(user_name, format_chat_history(items),
+                                  user_summary)
+        messages.append({'role': 'system', 'content': system})
+        messages.append({'role': 'user', 'content': user_input})
+        return messages
+
+    async def store(chroma, user_input, user_name, user_id, reply):
+        t = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+        text = f'{user_name}: {user_input}\n{name}: {reply}'
+        texts = [text]
+        ids = [str(uuid.uuid4()) for _ in texts]
+
+        with span('embed'):
+            embeddings = await encode_async(texts, cache=False)
+        metadatas = [{
             'user_id': user_id,
-            'user_input': user_input,
-            'response': reply,
-            't': datetime.now(ZoneInfo("Asia/Taipei")),
-        }
-        mongo.insert_many([entry])
+            'time': t,
+        }]
+        entry = create_chat_entry(model, user_id, user_input, reply)
+        with span('store'):
+            await save(chroma, ids, embeddings, texts, metadatas, entry)
+            if memory is not None:
+                await memory.add(chroma, user_id, ids, embeddings, texts,
+                                 metadatas)
+        if summary is not None:
+            summary.schedule(user_id)
+
+    async def chat(user_input, user_name, user_id):
+        chroma = await get_chroma()
+        messages = await create_messages(chroma, user_input, user_name, user_id)
+
+        async with scheduler.slot(model) as keep_alive:
+            with span('generate', model=model):
+                response = await async_ollama_client.chat(
+                    model=model, messages=messages, keep_alive=keep_alive)
+        prompt_stats.record(name, response)
+        reply = response['message']['content']
+        log_turn(logger, name, system=messages[0]['content'], user=user_input,
+                 reply=reply)
+
+        await store(chroma, user_input, user_name, user_id, reply)
         return reply
 
+    async def chat_stream(user_input, user_name, user_id):
+        chroma = await get_chroma()
+        messages = await create_messages(chroma, user_input, user_name, user_id)
+
+        parts = []
+        async with scheduler.slot(model) as keep_alive:
+            with span('generate', model=model):
+                stream = await async_ollama_client.chat(
+                    model=model, messages=messages, stream=True,
+                    keep_alive=keep_alive)
+                async for part in stream:
+                    if part.get('done'):
+                        prompt_stats.record(name, part)
+                    content = part['message']['content']
+                    parts.append(content)
+                    yield content
+        reply = ''.join(parts)
+        log_turn(logger, name, system=messages[0]['content'], user=user_input,
+                 reply=reply)
+
+        await store(chroma, user_input, user_name, user_id, reply)
+
+    chat.stream = chat_stream
     return chat
@@ -0,0 +1,162 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+from fastapi import HTTPException
+
+from idempotency import deduplicator
+from stats import percentile
+
+logger = logging.getLogger('uvicorn')
+
+WEBHOOK_MODE = os.getenv('WEBHOOK_MODE', 'inline')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '256'))
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv('WEBHOOK_QUEUE_TIMEOUT', '1.0'))
+# how long shutdown waits for queued events before cancelling the workers
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30'))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class WorkerPool:
+    """Drains webhook events with a fixed number of workers.
+
+    Events are grouped by key (the LINE user), and a key is owned by at
+    most one worker at a time, so each user's events run strictly in
+    order while different users run concurrently.
+    """
+
+    def __init__(self, size, max_pending, timeout, window=1000):
+        self.size = size
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(max_pending)
+        self.ready = asyncio.Queue()
+        self.pending = {}
+        self.workers = []
+        self.depth = 0
+        self.max_depth = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.waits = deque(maxlen=window)
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def start(self):
+        if self.workers:
+            return
+        for i in range(self.size):
+            self.workers.append(asyncio.create_task(self.work(i)))
+
+    async def close(self, timeout=0):
+        """Waits up to timeout seconds for the queued events, then stops
+        the workers."""
+        if self.workers and timeout > 0:
+            try:
+                await asyncio.wait_for(self.idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f'webhook queue closed with {self.depth} events left')
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def submit(self, key, handler, event):
+        self.start()
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise QueueFull()
+
+        jobs = self.pending.get(key)
+        if jobs is None:
+            jobs = deque()
+            self.pending[key] = jobs
+            self.ready.put_nowait(key)
+        jobs.append((time.monotonic(), handler, event))
+        self.depth += 1
+        self.idle.clear()
+        self.max_depth = max(self.max_depth, self.depth)
+
+    async def work(self, index):
+        while True:
+            key = await self.ready.get()
+            jobs = self.pending[key]
+            while jobs:
+                enqueued, handler, event = jobs.popleft()
+                self.record_wait(time.monotonic() - enqueued)
+                try:
+                    await handler(event)
+                    self.processed += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.failed += 1
+                    logger.exception(f'webhook worker {index} failed on {key}')
+                finally:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        self.idle.set()
+                    self.slots.release()
+            del self.pending[key]
+
+    def record_wait(self, wait):
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.waits.append(wait)
+
+    def stats(self):
+        started = self.processed + self.failed
+        return {
+            'mode': WEBHOOK_MODE,
+            'workers': len(self.workers),
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'active_users': len(self.pending),
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'wait_avg': self.wait_total / started if started else 0.0,
+            'wait_p50': percentile(self.waits, 0.5),
+            'wait_p95': percentile(self.waits, 0.95),
+            'wait_max': self.wait_max,
+        }
+
+
+pool = WorkerPool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_QUEUE_TIMEOUT)
+
+
+def event_key(event):
+    source = event.source
+    for attr in ('user_id', 'group_id', 'room_id'):
+        key = getattr(source, attr, None)
+        if key:
+            return key
+    return None
+
+
+async def dispatch(events, handle_event):
+    # claim each event only when it is about to be handled: if one fails,
+    # LINE resends the whole batch and the events after it must not look
+    # like duplicates then
+    handle_event = deduplicator.guard(handle_event)
+    for event in events:
+        if not await deduplicator.claim(event):
+            continue
+        if WEBHOOK_MODE != 'queue':
+            await handle_event(event)
+            continue
+        try:
+            await pool.submit(event_key(event), handle_event, event)
+        except QueueFull:
+            # LINE retries the whole request, let it through next time
+            await deduplicator.release(event)
+            raise HTTPException(status_code=503, detail="Webhook queue is full")
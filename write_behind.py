@@ -0,0 +1,165 @@
+import os
+import glob
+import asyncio
+import logging
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger('uvicorn')
+
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', '1') == '1'
+WRITE_BEHIND_DIR = os.getenv('WRITE_BEHIND_DIR', 'data/journal')
+WRITE_BEHIND_SIZE = int(os.getenv('WRITE_BEHIND_SIZE', '64'))
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', '1.0'))
+
+
+class WriteBehind:
+    """Buffers writes per sink and flushes them in bulk.
+
+    Every record is appended to a journal segment before it is buffered.
+    A flush seals the current segment, and sealed segments are deleted
+    once every record in them has been written, so on start whatever is
+    left in the journal is replayed. Sinks are async callables that take
+    a list of records and must tolerate seeing a record twice.
+    """
+
+    def __init__(self, directory, flush_size, flush_interval):
+        self.directory = directory
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.sinks = {}
+        self.buffer = []
+        self.sealed = []
+        self.segment = None
+        self.segment_index = 0
+        self.flush_lock = None
+        self.task = None
+        self.flushes = 0
+        self.written = 0
+        self.failures = 0
+        self.replayed = 0
+
+    def register(self, name, sink):
+        self.sinks[name] = sink
+
+    def open_segment(self):
+        self.segment_index += 1
+        path = os.path.join(self.directory, f'{self.segment_index:012d}.jsonl')
+        self.segment = open(path, 'a')
+
+    def seal_segment(self):
+        if self.segment.tell() == 0:
+            return
+        self.segment.close()
+        self.sealed.append(self.segment.name)
+        self.open_segment()
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.flush_lock = asyncio.Lock()
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.jsonl'))):
+            with open(path, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    item = json_util.loads(line)
+                    self.buffer.append((item['sink'], item['record']))
+                    self.replayed += 1
+            self.sealed.append(path)
+            index = int(os.path.basename(path).split('.')[0])
+            self.segment_index = max(self.segment_index, index)
+        self.open_segment()
+        if self.replayed:
+            logger.info(f'replaying {self.replayed} journaled writes')
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, sink, record):
+        line = json_util.dumps({'sink': sink, 'record': record})
+        self.segment.write(line + '\n')
+        self.segment.flush()
+        self.buffer.append((sink, record))
+        if len(self.buffer) >= self.flush_size:
+            asyncio.ensure_future(self.flush())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.buffer:
+                return
+            batch = self.buffer
+            self.buffer = []
+            self.seal_segment()
+            sealed = list(self.sealed)
+
+            groups = {}
+            for sink, record in batch:
+                groups.setdefault(sink, []).append(record)
+
+            failed = []
+            for sink, records in groups.items():
+                try:
+                    await self.sinks[sink](records)
+                    self.written += len(records)
+                except Exception:
+                    self.failures += 1
+                    logger.exception(f'write behind flush to {sink} failed')
+                    failed += [(sink, record) for record in records]
+
+            self.flushes += 1
+            if failed:
+                # retried on the next flush, the segments stay until then
+                self.buffer = failed + self.buffer
+                return
+            for path in sealed:
+                os.remove(path)
+                self.sealed.remove(path)
+
+    async def close(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        await self.flush()
+        self.segment.close()
+        if os.path.getsize(self.segment.name) == 0:
+            os.remove(self.segment.name)
+
+    def stats(self):
+        return {
+            'buffered': len(self.buffer),
+            'sealed_segments': len(self.sealed),
+            'flushes': self.flushes,
+            'written': self.written,
+            'failures': self.failures,
+            'replayed': self.replayed,
+        }
+
+
+def only_duplicates(e):
+    # entries carry their own _id, so a replayed insert only hits duplicates
+    errors = e.details.get('writeErrors', [])
+    return all(error['code'] == 11000 for error in errors)
+
+
+async def insert_entries(mongo, entries):
+    try:
+        await mongo.insert_many(entries, ordered=False)
+    except BulkWriteError as e:
+        if not only_duplicates(e):
+            raise
+
+
+def create_writer():
+    if not WRITE_BEHIND:
+        return None
+    return WriteBehind(WRITE_BEHIND_DIR, WRITE_BEHIND_SIZE,
+                       WRITE_BEHIND_INTERVAL)
+
+
+writer = create_writer()